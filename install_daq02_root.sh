@@ -2,6 +2,8 @@
 
 echo "Installation/update starts .... (requiring root account)"
 
+sudo -u phnxrc bash -c 'cd /home/phnxrc/sepd/sEPD_SlowControls && source ./venv/bin/activate && pip install gunicorn'
+
 cp -fv sepd_exporter.service /usr/lib/systemd/system/sepd_exporter.service
 
 systemctl daemon-reload
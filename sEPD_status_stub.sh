@@ -0,0 +1,20 @@
+#!/bin/bash
+
+# Stand-in for /home/phnxrc/BiasControl/sEPD_status.sh when testing without
+# the bias crate.  Prints one line per channel in the same columns:
+#   name setpoint current_limit voltage current ramp state status
+# SEPD_STUB_DELAY adds a delay in seconds, SEPD_STUB_OFF lists channels which are off.
+
+sleep ${SEPD_STUB_DELAY:-0}
+
+for channel in $(seq -w 0 23); do
+    state="on"
+    readback=$(printf "%d.%02d" 54 $((RANDOM % 100)))
+    current=$(printf "%d.%02d" $((RANDOM % 3)) $((RANDOM % 100)))
+    if [[ ",${SEPD_STUB_OFF}," == *",${channel},"* ]]; then
+        state="off"
+        readback="0.00"
+        current="0.00"
+    fi
+    echo "ch_${channel} 55.00 10.00 ${readback} ${current} 5.0 ${state} Ok"
+done
@@ -0,0 +1,242 @@
+"""
+Sharded operation of the exporter.
+
+Each worker exporter reads some of the crates (see "workers" in the config
+file) and serves its latest snapshot as json on /snapshot.  An aggregating
+exporter fetches every worker from its own thread and merges their snapshots
+into one, so /metrics keeps a single set of labels built from the interface
+mapping while a hung crate only ever delays its own worker.
+"""
+
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+import sepd_sc_channels
+import sepd_sc_monitoring
+
+default_worker_timeout = 2 # seconds
+default_worker_expiry = 60 # seconds
+
+
+"""
+Serialises a snapshot for /snapshot.  The channel arrays are sent as nested
+lists, unread channels as NaN, which python's json reads back.  The per
+board temperature and current readings are left out, the channel arrays
+carry the same values.
+"""
+def encode_snapshot(snapshot, delta_counts):
+    metrics = {quantity : values for quantity, values in snapshot.metrics.items()
+               if quantity not in sepd_sc_channels.ChannelStore.quantities}
+    channels = metrics.pop("channels")
+    return json.dumps({"generation" : snapshot.generation,
+                       "timestamp" : snapshot.timestamp,
+                       "duration" : snapshot.duration,
+                       "last_update" : snapshot.last_update,
+                       "health" : snapshot.health,
+                       "polled" : snapshot.polled,
+                       "metrics" : metrics,
+                       "channels" : {"values" : {quantity : values.tolist() for quantity, values in channels.values.items()},
+                                     "stale" : {quantity : stale.tolist() for quantity, stale in channels.stale.items()}},
+                       "delta_counts" : [[quantity, result, count] for (quantity, result), count in delta_counts.items()]},
+                      separators=(",", ":"))
+
+def decode_snapshot(payload, channel_map):
+    data = json.loads(payload)
+    store = sepd_sc_channels.ChannelStore(channel_map)
+    for quantity, values in data["channels"]["values"].items():
+        store.values[quantity] = np.asarray(values, dtype=float)
+    for quantity, stale in data["channels"]["stale"].items():
+        store.stale[quantity] = np.asarray(stale, dtype=bool)
+    data["metrics"]["channels"] = store
+    data["delta_counts"] = {(quantity, result) : count for quantity, result, count in data["delta_counts"]}
+    return data
+
+
+"""
+Fetches one worker's /snapshot every interval seconds in its own thread.
+The last snapshot received is kept in .latest, and callback is called
+whenever it changes.
+"""
+class WorkerClient:
+    def __init__(self, name, url, channel_map, interval, timeout=default_worker_timeout, callback=None):
+        self.name = name
+        self.url = url.rstrip("/") + "/snapshot"
+        self.channel_map = channel_map
+        self.interval = interval
+        self.timeout = timeout
+        self.callback = callback
+        self.latest = None
+        self.last_success = None
+        self.failures = 0
+        self.etag = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name=f"sepd-worker-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def up(self, expiry):
+        return self.last_success is not None and time.time() - self.last_success < expiry
+
+    def fetch(self):
+        headers = {"If-None-Match" : self.etag} if self.etag is not None else {}
+        start_time = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url, headers=headers), timeout=self.timeout) as response:
+                payload = response.read()
+                etag = response.headers.get("ETag")
+            sepd_sc_monitoring.recorder.command(self.name, "/snapshot", "", time.perf_counter() - start_time)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            self.last_success = time.time()
+            return False
+        self.latest = decode_snapshot(payload, self.channel_map)
+        self.etag = etag
+        self.last_success = time.time()
+        return True
+
+    def run(self):
+        while not self._stop.is_set():
+            start_time = time.time()
+            try:
+                if self.fetch() and self.callback is not None:
+                    self.callback(self)
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"worker {self.name}: could not fetch {self.url}: {type(e)}: {e}")
+            self._stop.wait(max(0, self.interval - (time.time() - start_time)))
+
+
+"""
+Stands in for sepdPoller in an aggregating exporter: publishes a Snapshot
+merged from the workers' latest snapshots every time one of them changes.
+Workers which have not answered for worker_expiry seconds are left out, so
+their series disappear instead of being exported forever; a background
+thread merges again when a worker expires, even if no other worker
+changed.  The same thread appends the merged readings to the monitor's
+history buffer once every min_interval (at least a second), storing only
+the quantities some worker polled since the last append, so the buffer
+covers as long as it does in a single exporter.
+"""
+class sepdAggregator:
+    def __init__(self, monitor, min_interval=1, callback=None):
+        self.monitor = monitor
+        self.callback = callback
+        self.snapshot = None
+        self.generation = 0
+        self.expiry = monitor.configs.get("worker_expiry", default_worker_expiry)
+        self.lock = threading.Lock()
+        self.interval = min_interval
+        self.merged = None # names of the workers in the last merge
+        self.polled = set() # quantities the workers polled since the last history append, None for all
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="sepd-aggregator", daemon=True)
+        self.workers = {}
+        for name, worker in monitor.configs.get("workers", {}).items():
+            self.workers[name] = WorkerClient(name, worker["url"], monitor.channel_map, min_interval,
+                                              monitor.configs.get("worker_timeout", default_worker_timeout), self.merge)
+        if not self.workers:
+            logging.error("No workers found in config file")
+
+    @property
+    def failures(self):
+        return sum(worker.failures for worker in self.workers.values())
+
+    def start(self):
+        logging.info(f"Aggregating workers {', '.join(f'{name} ({worker.url})' for name, worker in self.workers.items())}")
+        for worker in self.workers.values():
+            worker.start()
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for worker in self.workers.values():
+            worker.stop(timeout)
+        self._thread.join(timeout)
+
+    def live(self):
+        return {name for name, worker in self.workers.items() if worker.latest is not None and worker.up(self.expiry)}
+
+    def run(self):
+        while not self._stop.wait(max(self.interval, 1)):
+            live = self.live()
+            if self.merged is not None and live != self.merged:
+                logging.warning(f"Workers up changed from {sorted(self.merged)} to {sorted(live)} without a new snapshot, merging again")
+                self.merge()
+            self.record_history()
+
+    def record_history(self):
+        with self.lock:
+            snapshot, polled = self.snapshot, self.polled
+            self.polled = set()
+        if snapshot is not None and polled != set():
+            self.monitor.history.append(time.time(), snapshot.metrics, polled)
+
+    def age(self):
+        if self.snapshot is None:
+            return float("inf")
+        return time.time() - self.snapshot.timestamp
+
+    def delta_counts(self):
+        counts = {}
+        for worker in self.workers.values():
+            if worker.latest is not None:
+                for key, count in worker.latest["delta_counts"].items():
+                    counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def merge(self, updated=None):
+        start_time = time.perf_counter()
+        with self.lock:
+            if updated is not None:
+                polled = updated.latest.get("polled")
+                self.polled = None if polled is None or self.polled is None else self.polled | set(polled)
+            self.merged = self.live()
+            live = [self.workers[name].latest for name in self.merged]
+            metrics = {quantity : {} for quantity in ("temperatures", "gain_modes", "interface_voltages", "interface_currents",
+                                                      "lv_voltages", "lv_currents", "bias_info")}
+            channels = sepd_sc_channels.ChannelStore(self.monitor.channel_map)
+            last_update = {source : None for source in sepd_sc_monitoring.sources}
+            health = {}
+            for latest in live:
+                health.update(latest["health"])
+                for quantity in metrics:
+                    metrics[quantity].update(latest["metrics"].get(quantity, {}))
+                store = latest["metrics"]["channels"]
+                for quantity in store.quantities:
+                    rows = ~np.isnan(store.values[quantity]).all(axis=1)
+                    if quantity in store.stale:
+                        rows |= store.stale[quantity].any(axis=1)
+                        channels.stale.setdefault(quantity, np.zeros_like(store.stale[quantity]))[rows] = store.stale[quantity][rows]
+                    channels.values[quantity][rows] = store.values[quantity][rows]
+                for source, timestamp in latest["last_update"].items():
+                    if timestamp is not None and (last_update[source] is None or timestamp > last_update[source]):
+                        last_update[source] = timestamp
+            metrics["channels"] = channels
+
+            self.generation += 1
+            snapshot = sepd_sc_monitoring.Snapshot(generation=self.generation,
+                                                   timestamp=max((latest["timestamp"] for latest in live), default=time.time()),
+                                                   duration=max((latest["duration"] for latest in live), default=0),
+                                                   metrics=metrics,
+                                                   last_update=last_update,
+                                                   health=health,
+                                                   polled=None)
+            self.snapshot = snapshot
+        sepd_sc_monitoring.recorder.stage("merge", time.perf_counter() - start_time)
+        if updated is not None:
+            logging.debug(f"Merged snapshot {updated.latest['generation']} from worker {updated.name}")
+        if self.callback is not None:
+            self.callback(snapshot)
+        return snapshot
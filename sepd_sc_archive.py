@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+Append-only archive of every poll, and replay of archived polls.
+
+Each poll becomes one fixed-width record (record_dtype, about 8 kB): the
+12x64 temperatures and currents, interface board voltages and gain modes,
+the LV crate and the bias channels, all as float32 with NaN for anything
+not read.  Records go to <directory>/sepd_YYYYMMDD.bin, one file per UTC
+day, behind a short json header describing the record layout, so a file can
+be memory mapped with numpy:
+  records = sepd_sc_archive.load("archive/sepd_20240412.bin")
+  records["temperatures"][:, 3, 17]
+
+SnapshotArchiver only copies the poll into a record on the polling thread;
+a background thread writes the records out in batches.  ReplayMonitor is a
+drop in sepdMonitor which returns archived polls instead of reading the
+crates, at the recorded pace or faster.
+
+  python sepd_sc_archive.py archive/sepd_20240412.bin   prints a summary
+"""
+
+import argparse
+import atexit
+import glob
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+import sepd_sc_channels
+import sepd_sc_history
+import sepd_sc_monitoring
+
+magic = b"SEPDARC\0"
+archive_version = 1
+default_flush_interval = 10 # seconds
+default_bias_channels = 64
+gain_mode_codes = {"Normal" : 0, "High" : 1}
+
+record_dtype = np.dtype([("timestamp", "<f8"),
+                         ("last_update", "<f8", (len(sepd_sc_monitoring.sources),)),
+                         ("temperatures", "<f4", (sepd_sc_channels.n_boards, sepd_sc_channels.n_channels)),
+                         ("interface_currents", "<f4", (sepd_sc_channels.n_boards, sepd_sc_channels.n_channels)),
+                         ("interface_voltages", "<f4", (sepd_sc_channels.n_boards, len(sepd_sc_history.rails))),
+                         ("gain_modes", "i1", (sepd_sc_channels.n_boards,)),
+                         ("lv_voltages", "<f4", (2, 8, len(sepd_sc_history.lv_rails))),
+                         ("lv_currents", "<f4", (2, 8, len(sepd_sc_history.lv_rails))),
+                         ("bias", "<f4", (default_bias_channels, len(sepd_sc_history.bias_fields)))])
+
+
+"""
+Fills a record from a poll.  Bias channels are stored at their channel
+number; channels which are not numbers or do not fit are left out.
+"""
+def fill_record(record, timestamp, metrics, last_update):
+    record["timestamp"] = timestamp
+    record["last_update"] = [np.nan if last_update.get(source) is None else last_update[source] for source in sepd_sc_monitoring.sources]
+    for quantity in sepd_sc_channels.ChannelStore.quantities:
+        record[quantity] = metrics["channels"].values[quantity]
+
+    record["interface_voltages"] = np.nan
+    for board, reading in metrics["interface_voltages"].items():
+        record["interface_voltages"][int(board)] = [reading[rail] for rail in sepd_sc_history.rails]
+    record["gain_modes"] = -1
+    for board, mode in metrics["gain_modes"].items():
+        record["gain_modes"][int(board)] = gain_mode_codes.get(mode, -1)
+
+    for quantity in ("lv_voltages", "lv_currents"):
+        record[quantity] = np.nan
+        for board, channels in metrics[quantity].items():
+            for channel, reading in channels.items():
+                record[quantity][int(board) - 1, int(channel)] = [float(reading[rail]) for rail in sepd_sc_history.lv_rails]
+
+    record["bias"] = np.nan
+    for channel, reading in metrics["bias_info"].items():
+        if channel.isdigit() and int(channel) < default_bias_channels:
+            record["bias"][int(channel)] = [reading[field] for field in sepd_sc_history.bias_fields]
+
+"""
+The inverse of fill_record, returns the metrics dicts of sepdMonitor
+"""
+def record_metrics(record):
+    metrics = {quantity : {} for quantity in ("temperatures", "gain_modes", "interface_voltages", "interface_currents",
+                                              "lv_voltages", "lv_currents", "bias_info")}
+    for quantity in sepd_sc_channels.ChannelStore.quantities:
+        values = record[quantity].astype(float)
+        for board in np.nonzero(~np.isnan(values).all(axis=1))[0]:
+            metrics[quantity][int(board)] = values[board]
+    voltages = record["interface_voltages"].astype(float)
+    for board in np.nonzero(~np.isnan(voltages).any(axis=1))[0]:
+        metrics["interface_voltages"][int(board)] = dict(zip(sepd_sc_history.rails, voltages[board].tolist()))
+    for board in np.nonzero(record["gain_modes"] >= 0)[0]:
+        metrics["gain_modes"][int(board)] = "Normal" if record["gain_modes"][board] == gain_mode_codes["Normal"] else "High"
+    for quantity in ("lv_voltages", "lv_currents"):
+        values = record[quantity].astype(float)
+        for board, channel in zip(*np.nonzero(~np.isnan(values).any(axis=2))):
+            metrics[quantity].setdefault(int(board) + 1, {})[int(channel)] = dict(zip(sepd_sc_history.lv_rails, values[board, channel].tolist()))
+    bias = record["bias"].astype(float)
+    for channel in np.nonzero(~np.isnan(bias).any(axis=1))[0]:
+        reading = dict(zip(sepd_sc_history.bias_fields, bias[channel].tolist()))
+        reading["channel_state"] = int(reading["channel_state"])
+        reading["channel_okay"] = int(reading["channel_okay"])
+        metrics["bias_info"][f"{channel:02d}"] = reading
+    return metrics
+
+
+def header_bytes():
+    header = json.dumps({"version" : archive_version,
+                         "dtype" : np.lib.format.dtype_to_descr(record_dtype)}).encode()
+    header += b" " * (-(len(magic) + 4 + len(header)) % 16)
+    return magic + struct.pack("<I", len(header)) + header
+
+def read_header(f):
+    if f.read(len(magic)) != magic:
+        raise ValueError("not an sEPD archive file")
+    length, = struct.unpack("<I", f.read(4))
+    header = json.loads(f.read(length))
+    return np.lib.format.descr_to_dtype(header["dtype"]), len(magic) + 4 + length, header["version"]
+
+"""
+Memory maps the records of an archive file.  A record cut short by a crash
+at the end of the file is ignored.
+"""
+def load(file):
+    with open(file, "rb") as f:
+        dtype, offset, version = read_header(f)
+    count = (os.path.getsize(file) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file, dtype=dtype, mode="r", offset=offset, shape=(count,))
+
+def archive_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "sepd_*.bin")))
+    return [path]
+
+
+"""
+Appends polls to the daily archive files.  append() is called from the
+poller and only fills in a record; the records are written every
+flush_interval seconds by a background thread, and when the process exits.
+With keep_days set, daily files older than that many days are deleted.
+"""
+class SnapshotArchiver:
+    def __init__(self, directory, flush_interval=default_flush_interval, keep_days=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.pending = []
+        self.written = 0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="sepd-archiver", daemon=True)
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        logging.info(f"Archiving polls to {self.directory} every {self.flush_interval} seconds"
+                     + (f", keeping {self.keep_days} days" if self.keep_days is not None else ""))
+        self.prune()
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+    def append(self, timestamp, metrics, last_update):
+        record = np.zeros(1, dtype=record_dtype)[0]
+        fill_record(record, timestamp, metrics, last_update)
+        with self.lock:
+            self.pending.append(record)
+
+    def file_for(self, timestamp):
+        return os.path.join(self.directory, time.strftime("sepd_%Y%m%d.bin", time.gmtime(timestamp)))
+
+    """
+    Opens a daily file for appending.  A new file gets the header; an
+    existing one is cut back to its last whole record first, so a record cut
+    short by a crash or a full disk does not shift every later one.  A file
+    with another version or record layout is moved aside and started over.
+    """
+    def open_file(self, file):
+        size = os.path.getsize(file) if os.path.exists(file) else 0
+        if size > 0:
+            try:
+                with open(file, "rb") as f:
+                    dtype, offset, version = read_header(f)
+                compatible = version == archive_version and dtype == record_dtype
+            except (ValueError, TypeError, KeyError, struct.error) as e:
+                logging.error(f"Could not read the header of {file}: {e}")
+                compatible = False
+            if compatible:
+                end = offset + (size - offset) // dtype.itemsize * dtype.itemsize
+                f = open(file, "r+b")
+                if end != size:
+                    logging.warning(f"Dropping {size - end} bytes of a partial record at the end of {file}")
+                    f.truncate(end)
+                f.seek(end)
+                return f
+            aside = f"{file}.{int(time.time())}.incompatible"
+            logging.error(f"{file} is not a version {archive_version} archive with the current record layout, moving it to {aside}")
+            os.rename(file, aside)
+        f = open(file, "wb")
+        f.write(header_bytes())
+        return f
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        records = np.array(pending, dtype=record_dtype)
+        files = [self.file_for(timestamp) for timestamp in records["timestamp"]]
+        for file in sorted(set(files)):
+            batch = records[[name == file for name in files]]
+            try:
+                with self.open_file(file) as f:
+                    f.write(batch.tobytes())
+                self.written += len(batch)
+            except OSError as e:
+                logging.error(f"Could not archive {len(batch)} polls to {file}: {e}")
+        logging.debug(f"Archived {len(records)} polls")
+
+    def prune(self, now=None):
+        if self.keep_days is None:
+            return
+        if now is None:
+            now = time.time()
+        oldest = time.strftime("sepd_%Y%m%d.bin", time.gmtime(now - self.keep_days * 86400))
+        for file in archive_files(self.directory):
+            if os.path.basename(file) < oldest:
+                try:
+                    os.remove(file)
+                    logging.info(f"Deleted {file}, older than {self.keep_days} days")
+                except OSError as e:
+                    logging.error(f"Could not delete {file}: {e}")
+
+    def run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+            self.prune()
+
+
+"""
+Paces the replay: the next record is due when as much time has passed,
+divided by speed, as separates it from the first replayed record.  Once
+the replay has finished it only idles.
+"""
+class ReplayScheduler:
+    def __init__(self, speed):
+        self.speed = speed
+        self.start_wall = None
+        self.start_record = None
+        self.next_record = None
+        self.finished = False
+
+    def time_until_due(self, now):
+        if self.finished:
+            return sepd_sc_monitoring.default_timeout
+        if self.start_wall is None or self.next_record is None:
+            return 0
+        return max(0, self.start_wall + (self.next_record - self.start_record) / self.speed - now)
+
+    def restart(self, now, record_time):
+        self.start_wall = now
+        self.start_record = record_time
+
+
+"""
+A sepdMonitor which returns the polls archived in path (a file or a
+directory of daily files) instead of reading the crates.  Each call returns
+the next record; the freshness timestamps are shifted so the data looks
+live.  With loop the replay starts over at the end, otherwise the last
+record is repeated.  Run the exporter with -l 0 to replay faster than one
+poll per second.
+"""
+class ReplayMonitor(sepd_sc_monitoring.sepdMonitor):
+    def __init__(self, config_file, path, speed=1.0, loop=True):
+        super().__init__(config_file)
+        self.files = archive_files(path)
+        self.records = [records for records in (load(file) for file in self.files) if len(records)]
+        if not self.records:
+            raise ValueError(f"No archived polls in {path}")
+        self.loop = loop
+        self.position = (0, 0)
+        self.scheduler = ReplayScheduler(speed)
+        logging.info(f"Replaying {sum(len(records) for records in self.records)} polls from {len(self.files)} files at {speed}x")
+
+    """
+    Returns the current record and moves on, or returns the last record
+    again once a replay without loop has finished
+    """
+    def next_record(self):
+        file, row = self.position
+        record = self.records[file][row]
+        if self.scheduler.finished:
+            return record
+        if self.scheduler.start_wall is None:
+            self.scheduler.restart(time.time(), record["timestamp"])
+        row += 1
+        if row == len(self.records[file]):
+            file, row = file + 1, 0
+        if file < len(self.records):
+            self.scheduler.next_record = self.records[file][row]["timestamp"]
+            self.position = (file, row)
+        elif self.loop:
+            logging.info("Replay finished, starting over")
+            self.scheduler.start_wall = None
+            self.position = (0, 0)
+        else:
+            logging.info("Replay finished")
+            self.scheduler.finished = True
+        return record
+
+    def get_sEPD_metrics(self, quantities=None):
+        now = time.time()
+        record = self.next_record()
+
+        metrics = record_metrics(record)
+        for quantity in ("temperatures", "interface_voltages", "interface_currents", "lv_voltages", "lv_currents"):
+            setattr(self, quantity, metrics[quantity])
+        self.last_gain_state = metrics["gain_modes"]
+        self.bias = metrics["bias_info"]
+        offset = now - record["timestamp"]
+        for source, timestamp in zip(sepd_sc_monitoring.sources, record["last_update"]):
+            self.last_update[source] = None if np.isnan(timestamp) else float(timestamp) + offset
+        self.channels = sepd_sc_channels.ChannelStore.from_metrics(self.channel_map, metrics)
+        return self.metrics_response()
+
+    """
+    The crates are not read, so a source is up when the archived poll had
+    read it
+    """
+    def health(self):
+        return {source : {"up" : self.last_update[source] is not None, "open" : False, "last_success" : self.last_update[source]}
+                for source in self.sources}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='archive',
+        description='Summarises sEPD slow controls archive files',
+        epilog='')
+    parser.add_argument('path', help='Archive file or directory')
+    args = parser.parse_args()
+
+    for file in archive_files(args.path):
+        records = load(file)
+        if len(records) == 0:
+            print(f"{file}: empty")
+            continue
+        start, end = records["timestamp"][0], records["timestamp"][-1]
+        print(f"{file}: {len(records)} polls from {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start))} "
+              f"to {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(end))} UTC, "
+              f"{np.isfinite(records['temperatures']).any(axis=(1, 2)).sum()} with temperatures")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks sepdMonitor.get_sEPD_metrics and, optionally, a running exporter's
+/metrics endpoint.  Reports latency percentiles, throughput and CPU time per
+cycle, and can compare against a previous run to catch regressions.  CPU
+time is only reported for the acquisition, which runs in this process; the
+exporter's own CPU time is not visible from here.
+
+Typical use against the simulator:
+  python sepd_sc_benchmark.py --simulate -n 100 --output bench.json
+  python sepd_sc_benchmark.py --simulate -n 100 --baseline bench.json
+"""
+
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+logging.basicConfig(level=logging.WARNING)
+import sepd_sc_monitoring
+
+
+def summarize(wall_times, cpu_times):
+    wall_times = np.asarray(wall_times)
+    cpu_times = np.asarray(cpu_times)
+    return {"cycles" : len(wall_times),
+            "p50" : float(np.percentile(wall_times, 50)),
+            "p90" : float(np.percentile(wall_times, 90)),
+            "p99" : float(np.percentile(wall_times, 99)),
+            "max" : float(wall_times.max()),
+            "throughput" : float(len(wall_times) / wall_times.sum()),
+            "cpu_per_cycle" : float(cpu_times.mean()) if cpu_times.size else None}
+
+def run(function, cycles, warmup, cpu=True):
+    for _ in range(warmup):
+        function()
+    wall_times = []
+    cpu_times = []
+    for _ in range(cycles):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        function()
+        if cpu:
+            cpu_times.append(time.process_time() - cpu_start)
+        wall_times.append(time.perf_counter() - wall_start)
+    return summarize(wall_times, cpu_times)
+
+def benchmark_acquisition(config, cycles, warmup, overrides):
+    monitor = sepd_sc_monitoring.sepdMonitor(config)
+    monitor.configs.update(overrides)
+    monitor.connections = sepd_sc_monitoring.ConnectionManager(monitor.configs)
+    quantities = [quantity for quantity in sepd_sc_monitoring.default_schedule if quantity != "gain_modes"]
+    return run(lambda: monitor.get_sEPD_metrics(quantities), cycles, warmup) # full cycles, whatever the schedule
+
+def benchmark_scrape(url, cycles, warmup, gzipped):
+    headers = {"Accept-Encoding" : "gzip"} if gzipped else {}
+    def scrape():
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            response.read()
+    return run(scrape, cycles, warmup, cpu=False) # the client's CPU time says nothing about the exporter's
+
+def print_results(results):
+    print(f"{'benchmark':<28}{'cycles':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'per s':>10}{'cpu ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<28}{result['cycles']:>8}{result['p50'] * 1e3:>10.2f}{result['p90'] * 1e3:>10.2f}{result['p99'] * 1e3:>10.2f}"
+              f"{result['max'] * 1e3:>10.2f}{result['throughput']:>10.1f}"
+              + (f"{result['cpu_per_cycle'] * 1e3:>10.2f}" if result['cpu_per_cycle'] is not None else f"{'-':>10}"))
+
+"""
+Returns the benchmarks whose p50 or p99 latency grew by more than tolerance
+"""
+def regressions(results, baseline, tolerance):
+    regressed = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ("p50", "p99"):
+            if result[key] > baseline[name][key] * (1 + tolerance):
+                regressed.append(f"{name} {key}: {baseline[name][key] * 1e3:.2f} ms -> {result[key] * 1e3:.2f} ms")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Acquisition and scrape benchmarks for the sEPD slow controls exporter',
+        epilog='')
+    parser.add_argument('-c', '--sepd_config', default="monitoring_config.json", help='sEPD monitor config file')
+    parser.add_argument('-n', '--cycles', default=50, type=int, help='Number of measured cycles per benchmark')
+    parser.add_argument('--warmup', default=2, type=int, help='Number of unmeasured cycles before each benchmark')
+    parser.add_argument('--modes', default="serial,async", help='Comma separated acquisition modes to benchmark')
+    parser.add_argument('--url', default=None, help='/metrics URL of a running exporter to benchmark')
+    parser.add_argument('--simulate', action='store_true', help='Start sepd_sc_simulator.py for the duration of the benchmark')
+    parser.add_argument('--simulator_args', default="", help='Extra arguments for the simulator, e.g. "--latency 0.01 --off 3"')
+    parser.add_argument('--output', default=None, help='Write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='Compare against results previously written with --output')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Allowed relative latency increase over the baseline')
+    args = parser.parse_args()
+
+    simulator = None
+    if args.simulate:
+        simulator = subprocess.Popen([sys.executable, "sepd_sc_simulator.py", "-c", args.sepd_config] + args.simulator_args.split(),
+                                     stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+    results = {}
+    try:
+        for mode in args.modes.split(","):
+            for pipeline in (False, True):
+                name = f"acquisition_{mode}" + ("_pipelined" if pipeline else "")
+                results[name] = benchmark_acquisition(args.sepd_config, args.cycles, args.warmup,
+                                                      {"acquisition" : mode, "pipeline" : pipeline})
+        if args.url is not None:
+            results["scrape"] = benchmark_scrape(args.url, args.cycles, args.warmup, False)
+            results["scrape_gzip"] = benchmark_scrape(args.url, args.cycles, args.warmup, True)
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait()
+
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressed = regressions(results, json.load(f), args.tolerance)
+        for line in regressed:
+            print(f"REGRESSION {line}")
+        sys.exit(1 if regressed else 0)
@@ -0,0 +1,115 @@
+"""
+Array backed storage for the per channel interface board readings.
+
+Each quantity is kept as a 12x64 float array indexed by (interface board,
+channel), with index arrays built from the interface mapping to translate
+to (side, sector, tile).  Channels which were not read are NaN.
+"""
+
+import logging
+import numpy as np
+
+n_boards = 12
+n_channels = 64
+n_sides = 2
+n_sectors = 12
+n_tiles = 32
+side_names = ("north", "south")
+
+# Readings which mean the interface board is powered off
+board_off = {"temperatures" : lambda values: values < 0,
+             "interface_currents" : lambda values: values > 2045}
+
+
+"""
+Index arrays translating (interface board, channel) <-> (side, sector, tile),
+taken from a compiled sepd_sc_mapping.MappingIndex, unmapped entries are -1
+"""
+class ChannelMap:
+    def __init__(self, index):
+        self.side, self.sector, self.tile = index.forward
+        self.board, self.channel = index.reverse
+        self.mapped = self.side >= 0
+
+        # Label values for every channel, built once
+        sides, sectors, tiles = self.side.tolist(), self.sector.tolist(), self.tile.tolist()
+        self.labels = [[(side_names[sides[b][c]], str(sectors[b][c]), str(tiles[b][c])) if sides[b][c] >= 0 else None
+                        for c in range(n_channels)] for b in range(n_boards)]
+
+    """
+    Rearranges a 12x64 array into 2x12x32 (side, sector, tile)
+    """
+    def to_tiles(self, values):
+        tiles = np.full((n_sides, n_sectors, n_tiles), np.nan)
+        tiles[self.side[self.mapped], self.sector[self.mapped], self.tile[self.mapped]] = values[self.mapped]
+        return tiles
+
+
+class ChannelStore:
+    quantities = ("temperatures", "interface_currents")
+
+    def __init__(self, channel_map):
+        self.map = channel_map
+        self.values = {quantity : np.full((n_boards, n_channels), np.nan) for quantity in self.quantities}
+        self.stale = {} # quantity -> mask of channels to export as NaN, set by the delta filter
+        self.read = set() # quantities read from the crates in the poll which filled the store
+
+    """
+    Snapshots copy the readings but share the map, which never changes
+    """
+    def __deepcopy__(self, memo):
+        store = ChannelStore(self.map)
+        store.values = {quantity : values.copy() for quantity, values in self.values.items()}
+        store.stale = {quantity : stale.copy() for quantity, stale in self.stale.items()}
+        store.read = set(self.read)
+        return store
+
+    """
+    Builds a store from the per board lists of strings returned by the crates.
+    read defaults to every quantity.
+    """
+    @classmethod
+    def from_metrics(cls, channel_map, metrics, read=None):
+        store = cls(channel_map)
+        store.read = set(cls.quantities if read is None else read)
+        for quantity in cls.quantities:
+            for board, values in metrics[quantity].items():
+                store.update(quantity, board, values)
+        return store
+
+    """
+    Empties a quantity before it is read again
+    """
+    def clear(self, quantity):
+        self.values[quantity][:] = np.nan
+        self.read.add(quantity)
+
+    def update(self, quantity, board, values):
+        try:
+            values = np.asarray(values, dtype=float)
+        except ValueError as e:
+            logging.error(f"Could not parse {quantity} for interface board {board}: {e}")
+            return
+        if values.shape != (n_channels,):
+            logging.error(f"Expected {n_channels} {quantity} for interface board {board}, got {values.size}")
+            return
+        self.values[quantity][int(board)] = values
+
+    """
+    Mask of channels which were read and whose board is powered on
+    """
+    def valid(self, quantity):
+        values = self.values[quantity]
+        with np.errstate(invalid="ignore"):
+            return ~np.isnan(values) & ~board_off[quantity](values) & self.map.mapped
+
+    """
+    Mask of channels to export, the valid ones plus any marked stale
+    """
+    def exported(self, quantity):
+        if quantity in self.stale:
+            return self.valid(quantity) | self.stale[quantity]
+        return self.valid(quantity)
+
+    def tiles(self, quantity):
+        return self.map.to_tiles(np.where(self.valid(quantity), self.values[quantity], np.nan))
@@ -0,0 +1,78 @@
+"""
+Deadband filtering of the per channel readings before they are exported.
+
+The filter keeps the last published value of every channel and only
+forwards a new reading when it moves by more than the quantity's deadband,
+max(absolute, relative * |last published|).  Channels whose board switches
+off are published as NaN for a few snapshots, so they are marked stale
+instead of silently disappearing.
+"""
+
+import numpy as np
+
+import sepd_sc_channels
+
+default_stale_polls = 3
+
+
+class DeltaFilter:
+    results = ("forwarded", "suppressed", "stale")
+
+    def __init__(self, configs=None):
+        configs = configs if configs is not None else {}
+        shape = (sepd_sc_channels.n_boards, sepd_sc_channels.n_channels)
+        quantities = sepd_sc_channels.ChannelStore.quantities
+        self.deadbands = {}
+        for quantity in quantities:
+            deadband = configs.get("deadbands", {}).get(quantity, {})
+            self.deadbands[quantity] = (deadband.get("absolute", 0.0), deadband.get("relative", 0.0))
+        self.stale_polls = configs.get("stale_polls", default_stale_polls)
+        self.published = {quantity : np.full(shape, np.nan) for quantity in quantities}
+        self.live = {quantity : np.zeros(shape, dtype=bool) for quantity in quantities}
+        self.stale_count = {quantity : np.zeros(shape, dtype=np.int32) for quantity in quantities}
+        self.counts = {(quantity, result) : 0 for quantity in quantities for result in self.results}
+        self.last_published = None
+
+    """
+    Returns the metrics with "channels" replaced by the published values.
+    Only the quantities read this poll (store.read) are filtered and
+    counted, the others are published as they were last time.
+    """
+    def apply(self, metrics):
+        store = metrics["channels"]
+        if not store.read and self.last_published is not None:
+            return dict(metrics, channels=self.last_published)
+
+        published = sepd_sc_channels.ChannelStore(store.map)
+        published.read = set(store.read)
+        for quantity in store.quantities:
+            if quantity not in store.read:
+                if self.last_published is not None:
+                    published.values[quantity] = self.last_published.values[quantity]
+                    if quantity in self.last_published.stale:
+                        published.stale[quantity] = self.last_published.stale[quantity]
+                continue
+            values = store.values[quantity]
+            valid = store.valid(quantity)
+            last = self.published[quantity]
+            absolute, relative = self.deadbands[quantity]
+            with np.errstate(invalid="ignore"):
+                moved = np.abs(values - last) > np.maximum(absolute, relative * np.abs(last))
+            changed = valid & (np.isnan(last) | moved)
+            self.published[quantity] = np.where(changed, values, np.where(valid, last, np.nan))
+
+            went_off = self.live[quantity] & ~valid
+            count = np.where(valid, 0, np.where(went_off, self.stale_polls, self.stale_count[quantity]))
+            stale = ~valid & (count > 0)
+            self.stale_count[quantity] = np.maximum(count - 1, 0)
+            self.live[quantity] = valid
+
+            self.counts[(quantity, "forwarded")] += int(changed.sum())
+            self.counts[(quantity, "suppressed")] += int((valid & ~changed).sum())
+            self.counts[(quantity, "stale")] += int(went_off.sum())
+
+            published.values[quantity] = self.published[quantity].copy()
+            published.stale[quantity] = stale
+
+        self.last_published = published
+        return dict(metrics, channels=published)
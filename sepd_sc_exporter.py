@@ -12,39 +12,62 @@ TODO:
 
 import argparse
 import ctypes
-from flask import Response, Flask, request, render_template_string
+import functools
+import gzip
+import io
+from flask import Response, Flask, request, render_template_string, g
 import json
+import numpy
+import os
 import prometheus_client
-from prometheus_client import CollectorRegistry, Gauge, Info, Counter, Summary
+from prometheus_client import CollectorRegistry, Gauge, Info, Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from prometheus_client.exposition import choose_encoder
 import re
+import shlex
 import socket
 import time
 from threading import Lock
 import sys
+import urllib.parse
+import zlib
 import logging
 logging.basicConfig(level=logging.INFO)
 import sepd_sc_monitoring
+import sepd_sc_aggregator
+import sepd_sc_archive
+import sepd_sc_channels
+import sepd_sc_delta
+import sepd_sc_history
 
 # process input arguments
 parser = argparse.ArgumentParser(
     prog='status',
     description='Prometheus Data Exporter for sPHENIX sEPD Controls',
     epilog='')
-parser.add_argument('-p', '--port', default=5100,  help='Webservice port')
+parser.add_argument('-p', '--port', default=None,  help='Webservice port (default 5100, or the port of the worker url)')
 parser.add_argument('-l', '--limit', default=1,
-                    help='Scrubbing time throttling limit in seconds')
+                    help='Minimum time between polls of the crates (or fetches from the workers) in seconds')
 parser.add_argument('-c', '--sepd_config', default=None, help='sEPD monitor config file')
-args = parser.parse_args()
+parser.add_argument('-w', '--worker', default=None, help='Run as this worker from "workers" in the config file, reading only its sources')
+parser.add_argument('-a', '--aggregate', action='store_true', help='Merge the snapshots of the "workers" in the config file instead of reading the crates')
+parser.add_argument('-r', '--replay', default=None, help='Replay an archive file or directory instead of reading the crates')
+parser.add_argument('--speed', default=1, type=float, help='Replay speed relative to the recorded pace (use with -l 0 above 1 poll per second)')
+parser.add_argument('--replay_once', action='store_true', help='Stop at the end of the replay instead of starting over')
+if __name__ == "__main__":
+    args = parser.parse_args()
+else:
+    # imported by a WSGI server (see sepd_sc_wsgi.py), whose own command line is in sys.argv
+    args = parser.parse_args(shlex.split(os.environ.get("SEPD_EXPORTER_ARGS", "")))
 
 throttling_limit = float(args.limit)
-logging.info(f'Throttling request to no less than {throttling_limit} seconds')
+logging.info(f'Throttling polling to no less than {throttling_limit} seconds')
 
 # initialization
 metric_prefix = 'sphenix_sEPD'
 label_host = {}
 
 registry = CollectorRegistry()
-metrics = {}
 
 # Host prints
 logging.info(f"Host name:        {socket.gethostname()}")
@@ -52,156 +75,405 @@ label_host[f"hostname"] = socket.gethostname()
 
 request_counter = Counter(f'{metric_prefix}_request_counter', 'Requests processed',
                           list(label_host.keys()) + ['status'], registry=registry)
-request_time = Summary(f'{metric_prefix}_requests_processing_seconds', 'Inprogress HTTP requests',
-                       list(label_host.keys()), registry=registry)
+request_time = Histogram(f'{metric_prefix}_requests_processing_seconds', 'HTTP request processing time',
+                         list(label_host.keys()) + ['endpoint'], registry=registry,
+                         buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, float("inf")))
+
+
+
+worker_sources = None
+if args.worker is not None:
+    with open(args.sepd_config if args.sepd_config is not None else "monitoring_config.json", "r") as f:
+        worker = json.load(f)["workers"][args.worker]
+    worker_sources = worker.get("sources", [args.worker])
+    if args.port is None:
+        args.port = urllib.parse.urlparse(worker["url"]).port
+if args.port is None:
+    args.port = 5100
+
+"""
+HOT PATH INSTRUMENTATION, filled in by the monitor through its recorder hook
+"""
+class PrometheusRecorder(sepd_sc_monitoring.Recorder):
+    command_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, float("inf"))
+    parse_buckets = (.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005, .01, float("inf"))
+
+    def __init__(self, registry):
+        self.connect_time = Histogram(f'{metric_prefix}_crate_connect_seconds', "Time to open a connection to each crate",
+                                      ["crate"], registry=registry, buckets=self.command_buckets)
+        self.reconnects = Counter(f'{metric_prefix}_crate_reconnects', "Connection attempts after a failure",
+                                  ["crate"], registry=registry)
+        self.command_time = Histogram(f'{metric_prefix}_command_seconds', "Round trip time of each command, per board",
+                                      ["crate", "command", "board"], registry=registry, buckets=self.command_buckets)
+        self.parse_time = Histogram(f'{metric_prefix}_parse_seconds', "Time spent parsing each command's replies",
+                                    ["crate", "command"], registry=registry, buckets=self.parse_buckets)
+        self.timeouts = Counter(f'{metric_prefix}_readout_timeouts', "Readouts cut short by their deadline",
+                                ["crate", "reader"], registry=registry)
+        self.malformed_replies = Counter(f'{metric_prefix}_malformed_replies', "Replies which could not be parsed and were skipped",
+                                         ["crate", "command"], registry=registry)
+        self.stage_time = Histogram(f'{metric_prefix}_stage_seconds', "Time spent in each stage of a poll and of rendering /metrics",
+                                    ["stage"], registry=registry, buckets=self.command_buckets)
+
+    def connect(self, crate, seconds):
+        self.connect_time.labels(crate=crate).observe(seconds)
 
+    def reconnect(self, crate):
+        self.reconnects.labels(crate=crate).inc()
 
+    def command(self, crate, command, board, seconds):
+        self.command_time.labels(crate=crate, command=command, board=str(board)).observe(seconds)
 
-monitor = sepd_sc_monitoring.sepdMonitor(args.sepd_config)
+    def parse(self, crate, command, seconds):
+        self.parse_time.labels(crate=crate, command=command).observe(seconds)
 
+    def timeout(self, crate, reader):
+        self.timeouts.labels(crate=crate, reader=reader).inc()
+
+    def malformed(self, crate, command):
+        self.malformed_replies.labels(crate=crate, command=command).inc()
+
+    def stage(self, stage, seconds):
+        self.stage_time.labels(stage=stage).observe(seconds)
+
+recorder = PrometheusRecorder(registry)
+sepd_sc_monitoring.set_recorder(recorder)
+
+if args.replay is not None:
+    monitor = sepd_sc_archive.ReplayMonitor(args.sepd_config, args.replay, args.speed, not args.replay_once)
+else:
+    monitor = sepd_sc_monitoring.sepdMonitor(args.sepd_config, worker_sources)
+if args.worker is not None:
+    logging.info(f"Running as worker {args.worker} for {', '.join(monitor.sources)}")
+
+
+
+"""
+Yields the sEPD metrics straight from the latest snapshot.  Label values are
+built once from the interface mapping, and channels of powered off boards
+are simply not yielded, so nothing has to be cleared between refreshes.
+Each section is collected on its own, so a bad reading in one only loses
+that section and is counted in collect_errors.
+"""
+class sepdCollector:
+    bias_gauges = {"bias_setpoint" : {"name" : "Bias Setpoint", "unit" : "V"},
+                   "bias_readback" : {"name" : "Bias Readback", "unit" : "V"},
+                   "current_limit" : {"name" : "Current Trip Limit", "unit" : "uA"},
+                   "current_readback" : {"name" : "Current Readback", "unit" : "uA"},
+                   "channel_state" : {"name" : "Channel State", "unit" : ""},
+                   "channel_okay" : {"name" : "Channel Okay", "unit" : ""}}
 
+    def __init__(self, poller, channel_map, delta_counts):
+        self.poller = poller
+        self.delta_counts = delta_counts
+        self.channel_map = channel_map
+        sides = ["north" if channel_map.side[board, 0] == 0 else "south" for board in range(sepd_sc_channels.n_boards)]
+        self.interface_labels = {board : [sides[board], str(board % 6)] for board in range(sepd_sc_channels.n_boards)}
+        self.lv_labels = {(board, channel, rail) : [str(board), str(channel), rail]
+                          for board in (1, 2) for channel in range(8) for rail in ("positive", "negative")}
+        self.sections = {"interface" : interface_board_information,
+                         "lv" : lv_information,
+                         "bias" : bias_information,
+                         "health" : health_information}
+        self.section_errors = {section : 0 for section in self.sections}
+
+    def families(self):
+        families = {"temperatures" : GaugeMetricFamily(f'{metric_prefix}_temperatures', "Interface board temperatures", labels=["side", "sector", "tile"], unit="C"),
+                    "gain_modes" : GaugeMetricFamily(f'{metric_prefix}_gain_modes', "Interface board gain modes", labels=["side", "interface"]),
+                    "voltages" : GaugeMetricFamily(f'{metric_prefix}_voltages', "Interface board voltages", labels=["side", "interface", "rail"], unit="V"),
+                    "currents" : GaugeMetricFamily(f'{metric_prefix}_currents', "SiPM Currents", labels=["side", "sector", "tile"], unit="uA"),
+                    "lv_voltages" : GaugeMetricFamily(f"{metric_prefix}_lv_voltages", "LV crate voltages", labels=["board", "channel", "rail"], unit="V"),
+                    "lv_currents" : GaugeMetricFamily(f"{metric_prefix}_lv_currents", "LV crate currents", labels=["board", "channel", "rail"], unit="A"),
+                    "delta_updates" : CounterMetricFamily(f"{metric_prefix}_delta_updates", "Channel readings forwarded, suppressed by the deadband or marked stale",
+                                                          labels=["quantity", "result"]),
+                    "source_up" : GaugeMetricFamily(f"{metric_prefix}_source_up", "Whether the last read of each crate and interface board succeeded",
+                                                    labels=["source"]),
+                    "source_breaker_open" : GaugeMetricFamily(f"{metric_prefix}_source_breaker_open", "Whether each source is skipped apart from periodic probes",
+                                                              labels=["source"]),
+                    "source_last_success" : GaugeMetricFamily(f"{metric_prefix}_source_last_success", "Unix time of the last successful read of each source",
+                                                              labels=["source"], unit="seconds"),
+                    "collect_errors" : CounterMetricFamily(f"{metric_prefix}_collect_errors", "Exporter sections which failed to collect",
+                                                           labels=["section"])}
+        for key, gauge in self.bias_gauges.items():
+            families[key] = GaugeMetricFamily(f"{metric_prefix}_{key}", gauge["name"], labels=["channel"], unit=gauge["unit"])
+        return families
+
+    def describe(self):
+        return self.families().values()
+
+    def collect(self):
+        snapshot = self.poller.snapshot
+        families = self.families()
+        if snapshot is not None:
+            for section, collect_section in self.sections.items():
+                try:
+                    collect_section(families, snapshot, self)
+                except Exception as e:
+                    self.section_errors[section] += 1
+                    logging.error(f"Could not collect the {section} metrics: {type(e)}: {e}")
+        for (quantity, result), count in self.delta_counts().items():
+            families["delta_updates"].add_metric([quantity, result], count)
+        for section, count in self.section_errors.items():
+            families["collect_errors"].add_metric([section], count)
+        return families.values()
 
-def sepd_information(verbose=False):
-    # Voltage monitors
-    logging.debug("getting voltages")
-    all_metrics = monitor.get_sEPD_metrics()
-    logging.debug(json.dumps(all_metrics, sort_keys=True, indent=4))
 
-    """
-    INTERFACE BOARD METRICS
-    """
-    temperatures = all_metrics["temperatures"]
-    if "temperatures" not in metrics.keys():
-        metrics["temperatures"] = Gauge(f'{metric_prefix}_temperatures', "Interface board temperatures", ["side", "sector", "tile"], unit="C", registry=registry)
-    for interface_board in temperatures.keys():
-        for i, temp in enumerate(temperatures[interface_board]):
-            side, sector, tile = monitor.IB_to_tile[int(interface_board)][i]
-            
-            if float(temp) < 0: # means interface board is off
-                continue
-            side = "north" if side == 0 else "south"
-            metrics["temperatures"].labels(side=side, sector=sector, tile=tile).set(temp)
+"""
+INTERFACE BOARD METRICS
+"""
+def interface_board_information(families, snapshot, collector):
+    all_metrics = snapshot.metrics
+    channels = all_metrics["channels"]
+    for name, quantity in (("temperatures", "temperatures"), ("currents", "interface_currents")):
+        values = channels.values[quantity]
+        labels = channels.map.labels
+        for board, channel in zip(*numpy.nonzero(channels.exported(quantity))):
+            families[name].add_metric(labels[board][channel], values[board, channel])
 
     gain_modes = all_metrics["gain_modes"]
-    if "gain_modes" not in metrics.keys():
-        metrics["gain_modes"] = Gauge(f'{metric_prefix}_gain_modes', "Interface board gain modes", ["side", "interface"], registry=registry)
     for interface_board in gain_modes.keys():
-        side = "north" if monitor.IB_to_tile[int(interface_board)][0][0] == 0 else "south"
         gain_int = 0 if gain_modes[interface_board] == 'Normal' else 1
-        interface_board = interface_board % 6
-        metrics["gain_modes"].labels(side=side, interface=int(interface_board)).set(gain_int)
+        families["gain_modes"].add_metric(collector.interface_labels[int(interface_board)], gain_int)
 
     voltages = all_metrics["interface_voltages"]
-    if "voltages" not in metrics.keys():
-        metrics["voltages"] = Gauge(f'{metric_prefix}_voltages', "Interface board voltages", ["side", "interface", "rail"], unit="V", registry=registry)
     for interface_board in voltages.keys():
-        logging.debug(f"Writing for interface board {interface_board}")
         if float(voltages[interface_board]["positive"]) > 12:
             continue # means interface board is off
-        side = "north" if monitor.IB_to_tile[int(interface_board)][0][0] == 0 else "south"
-        interface_board = interface_board % 6
-        metrics["voltages"].labels(side=side, interface=int(interface_board), rail="positive").set(voltages[interface_board]["positive"])
-        metrics["voltages"].labels(side=side, interface=int(interface_board), rail="negative").set(voltages[interface_board]["negative"])
-        metrics["voltages"].labels(side=side, interface=int(interface_board), rail="bias").set(voltages[interface_board]["bias"])
-
-    currents = all_metrics["interface_currents"]
-    if "currents" not in metrics.keys():
-        metrics["currents"] = Gauge(f'{metric_prefix}_currents', "SiPM Currents", ["side", "sector", "tile"], unit="uA", registry=registry)
-    for interface_board in currents.keys():
-        for i, current in enumerate(currents[interface_board]):
-            side, sector, tile = monitor.IB_to_tile[int(interface_board)][i]
-            if float(current) > 2045: # means interface board is off
-                continue
-            side = "north" if side == 0 else "south"
-            metrics["currents"].labels(side=side, sector=sector, tile=tile).set(current)
-
-    """
-    LOW VOLTAGE CRATE METRICS
-    """
-    lv_voltages = all_metrics["lv_voltages"]
-    if "lv_voltages" not in metrics.keys():
-        metrics["lv_voltages"] = Gauge(f"{metric_prefix}_lv_voltages", "LV crate voltages", ["board", "channel", "rail"], unit="V", registry=registry)
-    for interface_board in lv_voltages.keys():
-        for channel in lv_voltages[interface_board]:
-            metrics["lv_voltages"].labels(board=int(interface_board), channel=int(channel), rail="positive").set(lv_voltages[interface_board][channel]["positive"])
-            metrics["lv_voltages"].labels(board=int(interface_board), channel=int(channel), rail="negative").set(lv_voltages[interface_board][channel]["negative"])
-
-    lv_currents = all_metrics["lv_currents"]
-    if "lv_currents" not in metrics.keys():
-        metrics["lv_currents"] = Gauge(f"{metric_prefix}_lv_currents", "LV crate currents", ["board", "channel", "rail"], unit="A", registry=registry)
-    for interface_board in lv_currents.keys():
-        for channel in lv_currents[interface_board]:
-            metrics["lv_currents"].labels(board=int(interface_board), channel=int(channel), rail="positive").set(lv_currents[interface_board][channel]["positive"])
-            metrics["lv_currents"].labels(board=int(interface_board), channel=int(channel), rail="negative").set(lv_currents[interface_board][channel]["negative"])
-
-
-    """
-    BIAS CRATE METRICS
-    """
-    bias_info = all_metrics["bias_info"]
-    bias_gauges = {"bias_setpoint" : {"name" : "Bias Setpoint", "unit" : "V"},
-                   "bias_readback" : {"name" : "Bias Readback", "unit" : "V"},
-                   "current_limit" : {"name" : "Current Trip Limit", "unit" : "uA"},
-                   "current_readback" : {"name" : "Current Readback", "unit" : "uA"},
-                   "channel_state" : {"name" : "Channel State", "unit" : ""},
-                   "channel_okay" : {"name" : "Channel Okay", "unit" : ""}}
-    for key in bias_gauges.keys():
-        if key not in metrics.keys():
-            metrics[key] = Gauge(f"{metric_prefix}_{key}", bias_gauges[key]["name"], ["channel"], unit=bias_gauges[key]["unit"], registry=registry)
+        labels = collector.interface_labels[int(interface_board)]
+        for rail in ("positive", "negative", "bias"):
+            families["voltages"].add_metric(labels + [rail], float(voltages[interface_board][rail]))
+
+"""
+LOW VOLTAGE CRATE METRICS
+"""
+def lv_information(families, snapshot, collector):
+    for name in ("lv_voltages", "lv_currents"):
+        readings = snapshot.metrics[name]
+        for board in readings.keys():
+            for channel in readings[board]:
+                for rail in ("positive", "negative"):
+                    families[name].add_metric(collector.lv_labels[(int(board), int(channel), rail)], float(readings[board][channel][rail]))
+
+"""
+BIAS CRATE METRICS
+"""
+def bias_information(families, snapshot, collector):
+    bias_info = snapshot.metrics["bias_info"]
     for channel in bias_info.keys():
-        for metric in bias_gauges.keys():
-            metrics[metric].labels(channel=channel).set(bias_info[channel][metric])
-    
+        for metric in collector.bias_gauges.keys():
+            families[metric].add_metric([channel], bias_info[channel][metric])
+
+"""
+SOURCE HEALTH, from the circuit breakers of the monitor
+"""
+def health_information(families, snapshot, collector):
+    for source, health in snapshot.health.items():
+        families["source_up"].add_metric([source], 1 if health["up"] else 0)
+        families["source_breaker_open"].add_metric([source], 1 if health["open"] else 0)
+        if health["last_success"] is not None:
+            families["source_last_success"].add_metric([source], health["last_success"])
+
+requests_metrics_lock = Lock() # serialises rendering a new payload, cached payloads are served without it
+
+"""
+Called from the poller thread with every new snapshot
+"""
+def refresh_metrics(snapshot):
+    logging.info(f'published snapshot {snapshot.generation} at {snapshot.timestamp}')
+    if logging.getLogger().isEnabledFor(logging.DEBUG): # dumping every metric costs ~11 ms
+        logging.debug(json.dumps(snapshot.metrics, sort_keys=True, indent=4, default=str))
+    request_counter.labels(status='updated', **label_host).inc()
+
+if args.aggregate:
+    poller = sepd_sc_aggregator.sepdAggregator(monitor, throttling_limit, refresh_metrics)
+    delta_counts = poller.delta_counts
+else:
+    delta_filter = sepd_sc_delta.DeltaFilter(monitor.configs)
+    archiver = None
+    if monitor.configs.get("archive_directory") is not None and args.replay is None:
+        archiver = sepd_sc_archive.SnapshotArchiver(monitor.configs["archive_directory"],
+                                                    monitor.configs.get("archive_flush_interval", sepd_sc_archive.default_flush_interval),
+                                                    monitor.configs.get("archive_keep_days"))
+    poller = sepd_sc_monitoring.sepdPoller(monitor, throttling_limit, refresh_metrics, delta_filter.apply, archiver)
+    delta_counts = lambda: delta_filter.counts
+registry.register(sepdCollector(poller, monitor.channel_map, delta_counts))
+
+"""
+FRESHNESS METRICS, evaluated at scrape time so they keep growing if the poller stalls
+"""
+snapshot_age = Gauge(f'{metric_prefix}_snapshot_age', "Time since the last completed poll", unit="seconds", registry=registry)
+snapshot_age.set_function(poller.age)
+snapshot_generation = Gauge(f'{metric_prefix}_snapshot_generation', "Number of completed polls", registry=registry)
+snapshot_generation.set_function(lambda: poller.generation)
+snapshot_duration = Gauge(f'{metric_prefix}_snapshot_duration', "Time taken by the last completed poll", unit="seconds", registry=registry)
+snapshot_duration.set_function(lambda: poller.snapshot.duration if poller.snapshot is not None else float("nan"))
+poll_failures = Gauge(f'{metric_prefix}_poll_failures', "Number of polls which raised an exception", registry=registry)
+poll_failures.set_function(lambda: poller.failures)
+
+def source_age(source):
+    snapshot = poller.snapshot
+    if snapshot is None or snapshot.last_update[source] is None:
+        return float("inf")
+    return time.time() - snapshot.last_update[source]
+
+source_freshness = Gauge(f'{metric_prefix}_source_age', "Time since each source last returned data", ["source"], unit="seconds", registry=registry)
+for source in monitor.sources:
+    source_freshness.labels(source=source).set_function(functools.partial(source_age, source))
+
+if args.aggregate:
+    worker_up = Gauge(f'{metric_prefix}_worker_up', "Whether each worker answered within worker_expiry seconds", ["worker"], registry=registry)
+    for name, client in poller.workers.items():
+        worker_up.labels(worker=name).set_function(functools.partial(client.up, poller.expiry))
+
 # web service
 app = Flask(__name__)
 
+@app.before_request
+def start_timer():
+    g.start_time = time.perf_counter()
+
+@app.after_request
+def observe_request_time(response):
+    if "start_time" in g:
+        request_time.labels(endpoint=request.endpoint or "unknown", **label_host).observe(time.perf_counter() - g.start_time)
+    return response
+
 @app.route('/')
 def index():
     return render_template_string("""
 <h1>Prometheus Data Exporter for sPHENIX EPD Slow Controls Values</h1>
 <p>Fetch metrics at <a href="./metrics">./metrics</a>.</p>
+<p>Recent readings at every poll are available from <a href="./history">./history</a>.</p>
+<p>The latest snapshot, as merged by an aggregating exporter, is at <a href="./snapshot">./snapshot</a>.</p>
 """)
 
-requests_metrics_lock = Lock()
-
-@app.route("/metrics")
-# @request_time.labels(**label_host).time() # did not work under python3.7
-def requests_metrics():
-
-    request_counter.labels(status='incoming', **label_host).inc()
-
-    with requests_metrics_lock:
-
-        start_time = time.time()
+"""
+Serves the latest snapshot as json for an aggregating exporter.  The ETag
+changes with every snapshot and every restart of the worker.
+"""
+started = time.time()
+
+@app.route("/snapshot")
+def snapshot():
+    latest = poller.snapshot
+    if latest is None:
+        return Response("no snapshot yet\n", status=503, mimetype='text/plain')
+    etag = f'"{started:.0f}-{latest.generation}"'
+    if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        return Response(status=304, headers={"ETag" : etag})
+    return Response(sepd_sc_aggregator.encode_snapshot(latest, delta_counts()), mimetype='application/json', headers={"ETag" : etag})
 
-        try:
-            if (time.time() - requests_metrics.lastcall < throttling_limit):
-                logging.warning('requests_metrics: Time litmit throttled....')
-                request_counter.labels(status='throttled', **label_host).inc()
+"""
+Returns recorded readings from the monitor's history buffer.
+  quantity  temperatures, interface_currents, interface_voltages,
+            lv_voltages, lv_currents or bias (default temperatures)
+  start     unix time, or seconds before now if negative (default -60)
+  end       unix time (default now)
+  tiles     side:sector:tile,... for temperatures and currents
+  channels  board:channel,... for temperatures and currents
+  format    json (default) or npz
+"""
+@app.route("/history")
+def history():
+    quantity = request.args.get("quantity", "temperatures")
+    if quantity not in monitor.history.quantities:
+        return Response(f"unknown quantity {quantity}\n", status=400, mimetype='text/plain')
+    try:
+        now = time.time()
+        start = float(request.args.get("start", -60))
+        if start < 0:
+            start += now
+        end = float(request.args.get("end", now))
+
+        index = None
+        labels = None
+        channel_map = monitor.channel_map
+        if "tiles" in request.args or "channels" in request.args:
+            if quantity not in sepd_sc_channels.ChannelStore.quantities:
+                return Response(f"tiles and channels only apply to {sepd_sc_channels.ChannelStore.quantities}\n", status=400, mimetype='text/plain')
+            if "tiles" in request.args:
+                tiles = [tile.split(":") for tile in request.args["tiles"].split(",")]
+                tiles = numpy.array([[sepd_sc_channels.side_names.index(side) if side in sepd_sc_channels.side_names else int(side), int(sector), int(tile)]
+                                     for side, sector, tile in tiles])
+                if (tiles < 0).any() or (tiles >= (sepd_sc_channels.n_sides, sepd_sc_channels.n_sectors, sepd_sc_channels.n_tiles)).any():
+                    raise ValueError("tile out of range") # negative values would index from the end
+                boards = channel_map.board[tuple(tiles.T)]
+                channels = channel_map.channel[tuple(tiles.T)]
             else:
-                logging.info(f'starting request calls at {time.time()}')
-                # refresh all readings
-                # clear metrics
-                for key, metric in metrics.items():
-                    metric.clear()
+                channels = numpy.array([channel.split(":") for channel in request.args["channels"].split(",")], dtype=int)
+                boards, channels = channels.T
+            if (boards < 0).any() or (channels < 0).any() or (boards >= sepd_sc_channels.n_boards).any() or (channels >= sepd_sc_channels.n_channels).any():
+                raise ValueError("selection out of range")
+            index = (boards, channels)
+            labels = [channel_map.labels[board][channel] for board, channel in zip(boards, channels)]
+    except (ValueError, IndexError) as e:
+        return Response(f"bad request: {e}\n", status=400, mimetype='text/plain')
+
+    times, values = monitor.history.query(quantity, start, end, index)
+
+    if request.args.get("format", "json") == "npz":
+        buffer = io.BytesIO()
+        numpy.savez(buffer, times=times, values=values)
+        return Response(buffer.getvalue(), mimetype='application/octet-stream')
+
+    result = {"quantity" : quantity,
+              "times" : times.tolist(),
+              "values" : numpy.where(numpy.isnan(values), None, values.astype(float).round(4)).tolist()}
+    if labels is not None:
+        result["labels"] = labels
+    if quantity == "bias":
+        result["channels"] = sorted(monitor.history.bias_channels, key=monitor.history.bias_channels.get)
+        result["fields"] = sepd_sc_history.bias_fields
+    return Response(json.dumps(result, separators=(",", ":")), mimetype='application/json')
 
-                # read all channel information
-                sepd_information()
-
-                requests_metrics.lastcall = time.time()
-                request_counter.labels(status='updated', **label_host).inc()
-                logging.info(f'ended request calls at {time.time()}')
+"""
+The exposition is rendered at most once per snapshot and representation, and
+reused until the next snapshot or for --limit seconds, whichever is first,
+so the freshness gauges never go stale by more than --limit.
+Cached payloads are read without taking requests_metrics_lock, so
+concurrent scrapes only wait for each other while a new payload is rendered.
+The cache dict is replaced rather than cleared, and payloads are only added
+to it under the lock.
+"""
+rendered = {"generation" : None, "time" : 0, "payloads" : {}}
+
+def render_metrics(accept, gzipped):
+    global rendered
+    encoder, content_type = choose_encoder(accept)
+    key = (content_type, gzipped)
+    cache = rendered
+    if cache["generation"] == poller.generation and time.time() - cache["time"] < throttling_limit and key in cache["payloads"]:
+        return cache["payloads"][key]
+    with requests_metrics_lock:
+        now = time.time()
+        if rendered["generation"] != poller.generation or now - rendered["time"] >= throttling_limit:
+            rendered = {"generation" : poller.generation, "time" : now, "payloads" : {}}
+        if key not in rendered["payloads"]:
+            start_time = time.perf_counter()
+            payload = encoder(registry)
+            if gzipped:
+                payload = gzip.compress(payload)
+            recorder.stage("render", time.perf_counter() - start_time)
+            etag = f'"{zlib.crc32(payload):08x}-{len(payload)}"'
+            rendered["payloads"][key] = (payload, content_type, etag)
+        return rendered["payloads"][key]
 
-        except Exception as e:
-            logging.error(f'requests_metrics: caught {type(e)}: {e}')
-            request_counter.labels(status='failed', **label_host).inc()
+@app.route("/metrics")
+def requests_metrics():
 
-        request_time.labels(**label_host).observe(time.time() - start_time)
+    request_counter.labels(status='incoming', **label_host).inc()
 
-    return Response(prometheus_client.generate_latest(registry), mimetype='text/plain')
+    gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+    payload, content_type, etag = render_metrics(request.headers.get("Accept"), gzipped)
 
-requests_metrics.lastcall = time.time()
+    headers = {"ETag" : etag, "Vary" : "Accept, Accept-Encoding"}
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        request_counter.labels(status='not_modified', **label_host).inc()
+        return Response(status=304, headers=headers)
+    return Response(payload, content_type=content_type, headers=headers)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=args.port)
-
+    poller.start()
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,99 @@
+"""
+Fixed size ring buffer of every polled reading.
+
+All arrays are allocated up front, appending a poll only copies values into
+the next row.  With float32 storage one hour of 1 Hz polling of all 768
+temperatures and currents takes about 22 MB.
+"""
+
+import threading
+import numpy as np
+
+import sepd_sc_channels
+
+default_samples = 3600
+default_bias_channels = 64
+bias_fields = ("bias_setpoint", "current_limit", "bias_readback", "current_readback", "channel_state", "channel_okay")
+rails = ("positive", "negative", "bias")
+lv_rails = ("positive", "negative")
+# scheduled quantity each history quantity is read with, where the names differ
+scheduled = {"lv_voltages" : "lv", "lv_currents" : "lv"}
+
+
+class HistoryBuffer:
+    quantities = ("temperatures", "interface_currents", "interface_voltages", "lv_voltages", "lv_currents", "bias")
+
+    def __init__(self, samples=default_samples, bias_channels=default_bias_channels):
+        n_boards = sepd_sc_channels.n_boards
+        n_channels = sepd_sc_channels.n_channels
+        self.samples = samples
+        self.times = np.full(samples, np.nan)
+        self.values = {"temperatures" : np.full((samples, n_boards, n_channels), np.nan, dtype=np.float32),
+                       "interface_currents" : np.full((samples, n_boards, n_channels), np.nan, dtype=np.float32),
+                       "interface_voltages" : np.full((samples, n_boards, len(rails)), np.nan, dtype=np.float32),
+                       "lv_voltages" : np.full((samples, 2, 8, len(lv_rails)), np.nan, dtype=np.float32),
+                       "lv_currents" : np.full((samples, 2, 8, len(lv_rails)), np.nan, dtype=np.float32),
+                       "bias" : np.full((samples, bias_channels, len(bias_fields)), np.nan, dtype=np.float32)}
+        self.bias_channels = {} # channel name -> row in the bias array
+        self.count = 0 # total number of polls appended
+        self.lock = threading.Lock()
+
+    def nbytes(self):
+        return self.times.nbytes + sum(values.nbytes for values in self.values.values())
+
+    """
+    Appends a poll.  polled lists the scheduled quantities which were read;
+    the others only carry their last readings over and are stored as NaN
+    rather than as new samples.  None stores everything.
+    """
+    def append(self, timestamp, metrics, polled=None):
+        with self.lock:
+            row = self.count % self.samples
+            self.times[row] = timestamp
+            for quantity in self.quantities:
+                self.values[quantity][row] = np.nan
+            read = [quantity for quantity in self.quantities if polled is None or scheduled.get(quantity, quantity) in polled]
+
+            for quantity in ("temperatures", "interface_currents"):
+                if quantity in read:
+                    self.values[quantity][row] = metrics["channels"].values[quantity]
+
+            if "interface_voltages" in read:
+                voltages = self.values["interface_voltages"][row]
+                for board, reading in metrics["interface_voltages"].items():
+                    voltages[int(board)] = [reading[rail] for rail in rails]
+
+            for quantity in ("lv_voltages", "lv_currents"):
+                if quantity in read:
+                    lv = self.values[quantity][row]
+                    for board, channels in metrics[quantity].items():
+                        for channel, reading in channels.items():
+                            lv[int(board) - 1, int(channel)] = [float(reading[rail]) for rail in lv_rails]
+
+            if "bias" in read:
+                bias = self.values["bias"][row]
+                for channel, reading in metrics["bias_info"].items():
+                    if channel not in self.bias_channels:
+                        if len(self.bias_channels) == bias.shape[0]:
+                            continue # no room left, the channel is not recorded
+                        self.bias_channels[channel] = len(self.bias_channels)
+                    bias[self.bias_channels[channel]] = [reading[field] for field in bias_fields]
+            self.count += 1
+
+    """
+    Returns the times and readings between start and end in chronological
+    order.  index selects within the per poll array of the quantity, for
+    example (boards, channels) for temperatures and currents.
+    """
+    def query(self, quantity, start, end, index=None):
+        with self.lock:
+            if self.count < self.samples:
+                rows = np.arange(self.count)
+            else:
+                rows = (np.arange(self.samples) + self.count) % self.samples
+            times = self.times[rows]
+            rows = rows[(times >= start) & (times <= end)]
+            values = self.values[quantity][rows]
+            if index is not None:
+                values = values[(slice(None),) + tuple(index)]
+            return self.times[rows], values
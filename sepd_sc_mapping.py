@@ -0,0 +1,136 @@
+"""
+Compiled interface mapping.
+
+The mapping text file (side sector tile interfaceBoard ch, one channel per
+line) is parsed and validated once and saved as two small .npy index arrays
+named after the file's hash, which later starts load memory mapped:
+  forward  (3, 12, 64) side, sector and tile of each (interface board, channel)
+  reverse  (2, 2, 12, 32) interface board and channel of each (side, sector, tile)
+Every one of the 12x64 channels has to map to exactly one of the 2x12x32
+tiles and the other way round, otherwise the mapping is refused.
+"""
+
+import hashlib
+import logging
+import os
+
+import numpy as np
+
+import sepd_sc_channels
+
+index_version = 1
+
+
+class MappingError(ValueError):
+    pass
+
+
+"""
+Parses the mapping text file into an (n, 5) array of
+(side, sector, tile, interface board, channel) rows
+"""
+def parse_mapping(file):
+    try:
+        rows = np.loadtxt(file, skiprows=1, dtype=np.int16, ndmin=2)
+    except ValueError as e:
+        raise MappingError(f"Could not parse {file}: {e}")
+    if rows.shape[1] != 5:
+        raise MappingError(f"Expected 5 columns in {file}, got {rows.shape[1]}")
+    return rows
+
+"""
+Checks the rows map the 12x64 interface board channels one to one onto the
+2x12x32 tiles
+"""
+def validate(rows, name="mapping"):
+    shape = (sepd_sc_channels.n_sides, sepd_sc_channels.n_sectors, sepd_sc_channels.n_tiles,
+             sepd_sc_channels.n_boards, sepd_sc_channels.n_channels)
+    columns = ("side", "sector", "tile", "interface board", "channel")
+    for column, size, values in zip(columns, shape, rows.T):
+        bad = (values < 0) | (values >= size)
+        if bad.any():
+            raise MappingError(f"{name}: {column} out of range [0, {size}) on {bad.sum()} lines, first {rows[bad][0].tolist()}")
+
+    for what, columns_shape, values in (("tile", shape[:3], rows[:, :3]), ("channel", shape[3:], rows[:, 3:])):
+        counts = np.bincount(np.ravel_multi_index(tuple(values.T), columns_shape), minlength=np.prod(columns_shape))
+        for problem, bad in (("mapped more than once", counts > 1), ("not mapped", counts == 0)):
+            if bad.any():
+                examples = [tuple(int(i) for i in np.unravel_index(flat, columns_shape)) for flat in np.nonzero(bad)[0][:5]]
+                raise MappingError(f"{name}: {bad.sum()} {what}s {problem}, e.g. {examples}")
+
+def compile_index(rows):
+    forward = np.full((3, sepd_sc_channels.n_boards, sepd_sc_channels.n_channels), -1, dtype=np.int8)
+    reverse = np.full((2, sepd_sc_channels.n_sides, sepd_sc_channels.n_sectors, sepd_sc_channels.n_tiles), -1, dtype=np.int8)
+    side, sector, tile, board, channel = rows.T
+    forward[:, board, channel] = side, sector, tile
+    reverse[:, side, sector, tile] = board, channel
+    return forward, reverse
+
+
+"""
+Two way lookups between (interface board, channel) and (side, sector, tile).
+All lookups take scalars or arrays and index straight into the compiled
+arrays.
+"""
+class MappingIndex:
+    def __init__(self, forward, reverse, file=None, digest=None):
+        self.forward = forward
+        self.reverse = reverse
+        self.file = file
+        self.digest = digest
+
+    def to_tile(self, boards, channels):
+        return tuple(self.forward[:, boards, channels])
+
+    def to_channel(self, sides, sectors, tiles):
+        return tuple(self.reverse[:, sides, sectors, tiles])
+
+    """
+    The mapping as (side, sector, tile, interface board, channel) rows,
+    ordered by interface board and channel
+    """
+    def rows(self):
+        board, channel = np.indices((sepd_sc_channels.n_boards, sepd_sc_channels.n_channels)).reshape(2, -1)
+        side, sector, tile = self.forward.reshape(3, -1)
+        return np.stack([side, sector, tile, board, channel], axis=1).astype(np.int16)
+
+
+def cache_paths(cache_dir, file, digest):
+    base = os.path.join(cache_dir, f"{os.path.basename(file)}.{digest[:16]}.v{index_version}")
+    return base + ".forward.npy", base + ".reverse.npy"
+
+"""
+Loads the compiled index of a mapping file, compiling and caching it first
+if the file changed.  cache_dir defaults to .mapping_cache next to the
+mapping file; if it cannot be written the mapping is still compiled, just
+not cached.
+"""
+def load(file, cache_dir=None):
+    with open(file, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(file)), ".mapping_cache")
+    forward_path, reverse_path = cache_paths(cache_dir, file, digest)
+
+    if os.path.exists(forward_path) and os.path.exists(reverse_path):
+        try:
+            index = MappingIndex(np.load(forward_path, mmap_mode="r"), np.load(reverse_path, mmap_mode="r"), file, digest)
+            logging.debug(f"Loaded compiled mapping {forward_path}")
+            return index
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load compiled mapping {forward_path}, recompiling: {e}")
+
+    rows = parse_mapping(file)
+    validate(rows, file)
+    forward, reverse = compile_index(rows)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, values in ((forward_path, forward), (reverse_path, reverse)):
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as f:
+                np.save(f, values)
+            os.replace(temporary, path)
+        logging.info(f"Compiled mapping {file} into {cache_dir}")
+    except OSError as e:
+        logging.warning(f"Could not cache the compiled mapping in {cache_dir}: {e}")
+    return MappingIndex(forward, reverse, file, digest)
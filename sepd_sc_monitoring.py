@@ -3,304 +3,1087 @@ Tristan Protzman
 Jul 23 2023
 """
 
+import asyncio
+import cProfile
 import json
 import logging
-import telnetlib
 import socket
 import functools
-import multiprocessing
+import contextlib
+import select
 import subprocess
-import csv
 import time
+import copy
+import threading
+import collections
 
-multiprocessing.set_start_method('fork')
+import sepd_sc_channels
+import sepd_sc_history
+import sepd_sc_mapping
+import sepd_sc_protocol
 
 default_timeout = 1 # seconds
+health_check_wait = 0.001 # seconds an idle async connection is listened to before use
+sources = ("lv", "north", "south", "bias")
+bias_script = "/home/phnxrc/BiasControl/sEPD_status.sh"
+
+# Per quantity polling defaults, the interval defaults to poll_rate and
+# everything can be overridden under "schedule" in the config file
+default_schedule = {"interface_currents" : {"priority" : 0},
+                    "temperatures" : {"priority" : 1},
+                    "lv" : {"priority" : 1},
+                    "bias" : {"priority" : 1},
+                    "interface_voltages" : {"priority" : 2},
+                    "gain_modes" : {"interval" : 600, "priority" : 3, "deadline" : 2}}
+controller_quantities = ("temperatures", "interface_voltages", "interface_currents", "gain_modes")
+side_offsets = {"north" : 0, "south" : 6} # first interface board of each controller crate
+source_quantities = {"lv" : ("lv",),
+                     "north" : controller_quantities,
+                     "south" : controller_quantities,
+                     "bias" : ("bias",)}
+
+_deadline = threading.local()
+
 
 """
-Applies a timeout to any functions which returns a dict
+Timing hooks called from the readout.  The base class records nothing; the
+exporter installs one that fills prometheus histograms with set_recorder().
+"""
+class Recorder:
+    def connect(self, crate, seconds):
+        pass
+
+    def reconnect(self, crate):
+        pass
+
+    def command(self, crate, command, board, seconds):
+        pass
+
+    def parse(self, crate, command, seconds):
+        pass
+
+    def timeout(self, crate, reader):
+        pass
+
+    def malformed(self, crate, command):
+        pass
+
+    def stage(self, stage, seconds):
+        pass
+
+recorder = Recorder()
+
+def set_recorder(new_recorder):
+    global recorder
+    recorder = new_recorder
+
+
+"""
+Seconds left before the deadline of the current thread expires, or default
+if no deadline is set.  Raises socket.timeout once it has expired.
+"""
+def remaining_time(default=None):
+    expires = getattr(_deadline, "expires", None)
+    if expires is None:
+        return default
+    remaining = expires - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("deadline expired")
+    return remaining
+
+"""
+Applies a timeout to generator functions yielding (key, value) pairs.  The
+pairs are collected into a dict; on timeout the ones read so far are returned.
+Callers can pass deadline=seconds to override the timeout.
 """
 def timeout(timeout):
     def decorator(func):
-        def return_value(func, retval, *args, **kwargs): # Uses a dict in shared memory rather than return value
-            retval.update(func(*args, **kwargs))
-
         @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            logging.debug(f"Starting thread for function {func.__name__}")
+        def wrapper(*args, deadline=None, **kwargs):
+            seconds = timeout if deadline is None else deadline
             value = {}
-            with multiprocessing.Manager() as manager:
-                value = manager.dict()
-                p = multiprocessing.Process(target=return_value, args=(func, value) + args, kwargs=kwargs)
-                p.start()
-                p.join(timeout)
-                if p.is_alive():
-                    logging.warning(f"Function {func.__name__} timed out in {timeout} seconds.  Terminating function...")
-                    p.terminate()
-                value = value.copy()
+            _deadline.expires = time.monotonic() + seconds
+            try:
+                for key, item in func(*args, **kwargs):
+                    value[key] = item
+            except (socket.timeout, subprocess.TimeoutExpired):
+                logging.warning(f"Function {func.__name__} timed out in {seconds} seconds.  Returning partial results...")
+                recorder.timeout(getattr(args[0], "name", "") if args else "", func.__name__)
+            except Exception as e: # a failed read only loses this function's data, as it did in the forked process
+                logging.error(f"Function {func.__name__} failed: {type(e)}: {e}")
+            finally:
+                _deadline.expires = None
             return value
         return wrapper
     return decorator
 
 
+"""
+Plain TCP replacement for telnetlib.Telnet (removed in python 3.13).  Reads
+honour the deadline set by the timeout decorator.  After a timeout the late
+reply would desynchronise later commands, so the socket is dropped and
+reopened on the next write.  Consecutive failures back off exponentially,
+the first reconnect is immediate.
+"""
+class CrateConnection:
+    def __init__(self, host, port, timeout, backoff=0.5, max_backoff=30, connect=True, pipeline=False, name=None):
+        self.name = name if name is not None else f"{host}:{port}"
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sock = None
+        self.buffer = sepd_sc_protocol.FrameBuffer()
+        self.failures = 0
+        self.next_attempt = 0
+        self.lock = threading.Lock()
+        if connect:
+            self.connect()
+
+    def connect(self):
+        wait = self.next_attempt - time.monotonic()
+        if wait > 0:
+            raise ConnectionError(f"Not reconnecting to {self.host}:{self.port} for another {wait:.1f} seconds")
+        self.buffer.clear()
+        if self.failures > 0:
+            recorder.reconnect(self.name)
+        start_time = time.perf_counter()
+        try:
+            self.sock = socket.create_connection((self.host, self.port), remaining_time(self.timeout))
+        except OSError:
+            self.failed()
+            raise
+        recorder.connect(self.name, time.perf_counter() - start_time)
+        logging.info(f"Connected to {self.host}:{self.port}")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def failed(self):
+        self.close()
+        self.failures += 1
+        if self.failures > 1:
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 2))
+            self.next_attempt = time.monotonic() + delay
+            logging.warning(f"{self.failures} consecutive failures on {self.host}:{self.port}, backing off for {delay} seconds")
+
+    """
+    Checks an idle connection is still open, discarding any bytes the crate
+    sent since the last command so they are not mistaken for a reply
+    """
+    def healthy(self):
+        if self.sock is None:
+            return False
+        try:
+            while select.select([self.sock], [], [], 0)[0]:
+                data = self.sock.recv(4096)
+                if not data:
+                    logging.info(f"Connection to {self.host}:{self.port} was closed by the crate")
+                    return False
+                logging.warning(f"Discarding {len(data)} unexpected bytes from {self.host}:{self.port}")
+        except OSError:
+            return False
+        self.buffer.clear()
+        return True
+
+    def ensure_connected(self):
+        if not self.healthy():
+            self.close()
+            self.connect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        if self.sock is None:
+            logging.debug(f"Reconnecting to {self.host}:{self.port}")
+            self.connect()
+        try:
+            self.sock.settimeout(remaining_time(self.timeout))
+            self.sock.sendall(data)
+        except OSError:
+            self.failed()
+            raise
+
+    def read_until(self, expected):
+        try:
+            while True:
+                data = self.buffer.pop(expected)
+                if data is not None:
+                    self.failures = 0
+                    return data
+                self.sock.settimeout(remaining_time(self.timeout))
+                chunk = self.sock.recv(4096)
+                if not chunk:
+                    raise EOFError(f"Connection to {self.host}:{self.port} closed")
+                self.buffer.feed(chunk)
+        except (OSError, EOFError):
+            self.failed()
+            raise
+
+
+"""
+asyncio counterpart of CrateConnection for the "async" acquisition.  The
+streams stay open between polls, so they are only used from the
+ConnectionManager's event loop.  An idle connection is checked before each
+session, a session which fails or is cancelled by its deadline drops the
+connection so a late reply cannot be taken for the next one, and
+reconnects back off the same way.
+"""
+class AsyncCrateConnection:
+    def __init__(self, host, port, backoff=0.5, max_backoff=30, name=None):
+        self.name = name if name is not None else f"{host}:{port}"
+        self.host = host
+        self.port = port
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reader = None
+        self.writer = None
+        self.failures = 0
+        self.next_attempt = 0
+
+    async def connect(self):
+        wait = self.next_attempt - time.monotonic()
+        if wait > 0:
+            raise ConnectionError(f"Not reconnecting to {self.host}:{self.port} for another {wait:.1f} seconds")
+        if self.failures > 0:
+            recorder.reconnect(self.name)
+        start_time = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            self.failed()
+            raise
+        recorder.connect(self.name, time.perf_counter() - start_time)
+        logging.info(f"Connected to {self.host}:{self.port}")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def failed(self):
+        self.close()
+        self.failures += 1
+        if self.failures > 1:
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures - 2))
+            self.next_attempt = time.monotonic() + delay
+            logging.warning(f"{self.failures} consecutive failures on {self.host}:{self.port}, backing off for {delay} seconds")
+
+    """
+    Checks an idle connection is still open, discarding any bytes the crate
+    sent since the last command so they are not mistaken for a reply
+    """
+    async def healthy(self):
+        if self.writer is None or self.writer.is_closing():
+            return False
+        try:
+            while True:
+                data = await asyncio.wait_for(self.reader.read(4096), health_check_wait)
+                if not data:
+                    logging.info(f"Connection to {self.host}:{self.port} was closed by the crate")
+                    return False
+                logging.warning(f"Discarding {len(data)} unexpected bytes from {self.host}:{self.port}")
+        except asyncio.TimeoutError:
+            return True
+        except OSError:
+            return False
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        if not await self.healthy():
+            self.close()
+            await self.connect()
+        try:
+            yield self.reader, self.writer
+        except BaseException:
+            self.failed()
+            raise
+        self.failures = 0
+
+
+"""
+Keeps one long lived connection per crate.  A session holds the crate's
+lock, so only one thread talks to a crate at a time, and checks the
+connection before handing it out.  The async acquisition keeps its own
+connections, in async_crates, and runs every poll on the same event loop
+so they stay open.
+"""
+class ConnectionManager:
+    def __init__(self, configs):
+        backoff = configs.get("reconnect_backoff", 0.5)
+        max_backoff = configs.get("max_reconnect_backoff", 30)
+        pipeline = configs.get("pipeline", False)
+        self.crates = {"lv" : CrateConnection(configs["lv_host"], configs["lv_port"], 0.5, backoff, max_backoff,
+                                              connect=False, pipeline=pipeline, name="lv")}
+        self.async_crates = {"lv" : AsyncCrateConnection(configs["lv_host"], configs["lv_port"], backoff, max_backoff, name="lv")}
+        self.loop = None
+        for side in ("north", "south"):
+            self.crates[side] = CrateConnection(configs[f"{side}_controller_host"], configs[f"{side}_controller_port"], 3,
+                                                backoff, max_backoff, connect=False, pipeline=pipeline, name=side)
+            self.async_crates[side] = AsyncCrateConnection(configs[f"{side}_controller_host"], configs[f"{side}_controller_port"],
+                                                           backoff, max_backoff, name=side)
+
+    @contextlib.contextmanager
+    def session(self, name):
+        crate = self.crates[name]
+        with crate.lock:
+            crate.ensure_connected()
+            yield crate
+
+    def run(self, coroutine):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        for crate in self.crates.values():
+            with crate.lock:
+                crate.close()
+        for crate in self.async_crates.values():
+            crate.close()
+
+
+"""
+Tracks whether a source, a crate or an interface board, is answering.
+After threshold consecutive failures the breaker opens and the source is
+skipped instead of waiting out its timeouts every poll, apart from one
+probe every probe_interval seconds.  The first success closes it again.
+"""
+class CircuitBreaker:
+    def __init__(self, name, threshold=3, probe_interval=30):
+        self.name = name
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.last_attempt = 0
+        self.last_success = None
+
+    @property
+    def open(self):
+        return self.failures >= self.threshold
+
+    def up(self):
+        return self.last_success is not None and self.failures == 0
+
+    def allow(self):
+        if not self.open:
+            return True
+        now = time.time()
+        if now - self.last_attempt < self.probe_interval:
+            return False
+        self.last_attempt = now
+        logging.info(f"Probing {self.name}")
+        return True
+
+    def success(self):
+        if self.open:
+            logging.info(f"{self.name} answered again after {self.failures} failures")
+        self.failures = 0
+        self.last_success = time.time()
+
+    def failure(self):
+        self.failures += 1
+        self.last_attempt = time.time()
+        if self.failures == self.threshold:
+            logging.error(f"{self.name} failed {self.failures} times in a row, only probing it every {self.probe_interval} seconds")
+
+
+"""
+Response parsers, shared between the socket and the asyncio clients
+"""
+parse_channels = sepd_sc_protocol.parse_channels
+parse_gain_mode = sepd_sc_protocol.parse_gain_mode
+parse_interface_voltages = sepd_sc_protocol.parse_interface_voltages
+parse_lv_channels = sepd_sc_protocol.parse_lv_channels
+parse_bias_status = sepd_sc_protocol.parse_bias_status
+
+
+"""
+Runs parser on a response and records how long it took.  A malformed
+response is logged and recorded, and None is returned.  out is passed on
+to parsers which fill a preallocated array.
+"""
+def timed_parse(crate, prefix, parser, response, board="", out=None):
+    start_time = time.perf_counter()
+    try:
+        value = parser(response) if out is None else parser(response, out=out)
+    except sepd_sc_protocol.ProtocolError as e:
+        logging.error(f"Malformed reply to {prefix}{board} from {crate}: {e}: {response[:80]!r}")
+        recorder.malformed(crate, prefix)
+        return None
+    recorder.parse(crate, prefix, time.perf_counter() - start_time)
+    return value
+
+"""
+Sends a command to each board and yields (board, parser(response)) as the
+replies arrive, skipping boards whose reply is malformed.  When pipelining,
+the whole batch is written up front and the '>' terminated replies are
+matched to the commands in order, so the batch costs one round trip instead
+of one per board.  The recorded round trip of a pipelined command runs from
+the batch being written.  With rows, each board's reply is parsed straight
+into rows[board].
+"""
+def query_boards(crate, prefix, boards, parser, pipeline=False, rows=None):
+    commands = ["{}{}".format(prefix, board).encode("ascii") + b"\n\r" for board in boards]
+    start_time = time.perf_counter()
+    if pipeline:
+        logging.debug("sending {} to crate".format(commands))
+        crate.write(b"".join(commands))
+    for board, command in zip(boards, commands):
+        if not pipeline:
+            logging.debug("sending {} to crate".format(command))
+            start_time = time.perf_counter()
+            crate.write(command)
+        response = crate.read_until(sepd_sc_protocol.terminator)
+        recorder.command(crate.name, prefix, board, time.perf_counter() - start_time)
+        logging.debug("received {}".format(response))
+        value = timed_parse(crate.name, prefix, parser, response, board, None if rows is None else rows[board])
+        if value is not None:
+            yield board, value
+
+
 """
 Gets the temperature of each SiPM on the interface boards,
-translated to the proper space
+translated to the proper space.  out is an optional 12x64 array to parse
+the readings into.
 """
 @timeout(default_timeout)
-def get_temperatures(crate, side):
-    temperatures = {}
+def get_temperatures(crate, side, boards=range(6), out=None):
     offset = 0
     if side == "south":
         offset = 6
-    for board in range(6):
-        command = "$T{}".format(board).encode("ascii") + b"\n\r"
-        logging.debug("sending {} to controller".format(command))
-        crate.write(command)
-        response = crate.read_until(b'>').decode()
-        logging.debug("received {}".format(response))
-        temperatures[board + offset] = response[:-1].split()
-    return temperatures
+    rows = None if out is None else out[offset:offset + 6]
+    for board, value in query_boards(crate, "$T", boards, parse_channels, crate.pipeline, rows):
+        yield board + offset, value
 
-#@timeout(default_timeout)
-def get_gain_mode(crate, side):
-    gain_modes = {}
+@timeout(2 * default_timeout)
+def get_gain_mode(crate, side, boards=range(6)):
     offset = 0
     if side == "south":
         offset = 6
-    for board in range(6):
-        # gain_modes[board + offset] = 'Normal'
-        # continue
-        command = "$A{}".format(board).encode("ascii") + b"\n\r"
-        logging.debug("sending {} to controller".format(command))
-        crate.write(command)
-        response = crate.read_until(b'>').decode()
-        logging.debug("received {}".format(response))
-        if 'Norm' in response:
-            gain_modes[board + offset] = 'Normal'
-        else:
-            gain_modes[board + offset] = 'High'
-    return gain_modes
+    for board, value in query_boards(crate, "$A", boards, parse_gain_mode, crate.pipeline):
+        yield board + offset, value
 
     
 @timeout(default_timeout)
-def get_interface_voltages(crate, side):
-    voltages = {}
+def get_interface_voltages(crate, side, boards=range(6)):
     offset = 0
     if side == "south":
         offset = 6
-    for board in range(6):
-        command = "$U{}".format(board).encode("ascii") + b"\n\r"
-        logging.debug("sending {} to controller".format(command))
-        crate.write(command)
-        response = crate.read_until(b'>').decode()
-        logging.debug("received {}".format(response))
-        response = response[:-2].split(",")
-        positive_voltage = float(response[0][response[0].find("=") + 1:].strip())
-        negative_voltage = float(response[1][response[1].find("=") + 1:].strip())
-        bias_voltage = float(response[2][response[2].find("=") + 1:].strip())
-        voltages[board + offset] = {"positive" : positive_voltage, "negative" : negative_voltage, "bias" : bias_voltage}
-    return voltages
+    for board, value in query_boards(crate, "$U", boards, parse_interface_voltages, crate.pipeline):
+        yield board + offset, value
 
 @timeout(default_timeout)
-def get_interface_current(crate, side):
-    currents = {}
+def get_interface_current(crate, side, boards=range(6), out=None):
     offset = 0
     if side == "south":
         offset = 6
-    for board in range(6):
-        command = "$I{}".format(board).encode("ascii") + b"\n\r"
-        logging.debug("sending {} to controller".format(command))
-        crate.write(command)
-        response = crate.read_until(b'>').decode()
-        logging.debug("received {}".format(response))
-        currents[board + offset] = response[:-1].split()
-    return currents
+    rows = None if out is None else out[offset:offset + 6]
+    for board, value in query_boards(crate, "$I", boards, parse_channels, crate.pipeline, rows):
+        yield board + offset, value
 
 @timeout(default_timeout)
-def get_lv_voltages(crate, fake=False):
-    voltagess = {}
-    if not fake:
-        for board in (1, 2):
-            command = "$V0{}".format(board).encode("ascii") + b"\n\r"
-            logging.debug("sending {} to lv crate".format(command))
-            crate.write(command)
-            response = crate.read_until(b'>').decode()
-            logging.debug("received {}".format(response))
-            v = response[2:-2].split(",")
-            voltagess[board] = {i : {"positive" : v[i], "negative" : v[i+8]} for i in range(8)}
-    else:
-        for board in (1, 2):
-            voltagess[board] = {i : {"positive" : -1, "negative" : -1} for i in range(8)}
-    return voltagess
+def get_lv_voltages(crate):
+    for board, value in query_boards(crate, "$V0", (1, 2), parse_lv_channels, crate.pipeline):
+        yield board, value
 
 @timeout(default_timeout)
-def get_lv_currents(crate, fake=False):
-    currents = {}
-    if not fake:
-        for board in (1, 2):
-            command = "$I0{}".format(board).encode("ascii") + b"\n\r"
-            logging.debug("sending {} to lv crate".format(command))
-            crate.write(command)
-            response = crate.read_until(b'>').decode()
-            logging.debug("received {}".format(response))
-            c = response[2:-2].split(",")
-            currents[board] = {i : {"positive" : c[i], "negative" : c[i+8]} for i in range(8)}
-    else:
-        for board in (1, 2):
-            currents[board] = {i : {"positive" : -1, "negative" : -1} for i in range(8)}
-
-    return currents
+def get_lv_currents(crate):
+    for board, value in query_boards(crate, "$I0", (1, 2), parse_lv_channels, crate.pipeline):
+        yield board, value
 
 @timeout(default_timeout)
-def get_bias_status():
-    bias_status = {}
+def get_bias_status(backend):
+    logging.debug("Getting bias crate info")
+    yield from backend.read().items()
+
+
+"""
+Asyncio versions of the crate readout, used when "acquisition" is set to
+"async" in the config file.  Results are written into the dicts passed in
+so that whatever was read before a deadline expired is kept, and the
+connected set, if given, collects the crates which could be reached.
+"""
+async def async_query_boards(name, reader, writer, prefix, boards, parser, pipeline=False, rows=None):
+    commands = ["{}{}".format(prefix, board).encode("ascii") + b"\n\r" for board in boards]
+    start_time = time.perf_counter()
+    if pipeline:
+        logging.debug("sending {} to crate".format(commands))
+        writer.write(b"".join(commands))
+        await writer.drain()
+    for board, command in zip(boards, commands):
+        if not pipeline:
+            logging.debug("sending {} to crate".format(command))
+            start_time = time.perf_counter()
+            writer.write(command)
+            await writer.drain()
+        response = await reader.readuntil(sepd_sc_protocol.terminator)
+        recorder.command(name, prefix, board, time.perf_counter() - start_time)
+        logging.debug("received {}".format(response))
+        value = timed_parse(name, prefix, parser, response, board, None if rows is None else rows[board])
+        if value is not None:
+            yield board, value
+
+controller_queries = {"temperatures" : ("$T", parse_channels),
+                      "interface_voltages" : ("$U", parse_interface_voltages),
+                      "interface_currents" : ("$I", parse_channels),
+                      "gain_modes" : ("$A", parse_gain_mode)}
+
+async def async_get_controller_metrics(metrics, crate, side, quantities, pipeline=False, boards=range(6), out=None, connected=None):
+    offset = 0
+    if side == "south":
+        offset = 6
+    async with crate.session() as (reader, writer):
+        if connected is not None:
+            connected.add(side)
+        for quantity in quantities:
+            prefix, parser = controller_queries[quantity]
+            rows = out[quantity][offset:offset + 6] if out is not None and quantity in out else None
+            async for board, value in async_query_boards(side, reader, writer, prefix, boards, parser, pipeline, rows):
+                metrics[quantity][board + offset] = value
+
+async def async_get_lv_metrics(metrics, crate, pipeline=False):
+    async with crate.session() as (reader, writer):
+        for prefix, quantity in (("$V0", "lv_voltages"), ("$I0", "lv_currents")):
+            async for board, value in async_query_boards("lv", reader, writer, prefix, (1, 2), parse_lv_channels, pipeline):
+                metrics[quantity][board] = value
+
+async def async_get_bias_status(metrics, backend):
     logging.debug("Getting bias crate info")
-    output = subprocess.check_output("/home/phnxrc/BiasControl/sEPD_status.sh").decode()
-    channel_info = [line for line in output.splitlines()]
-    for channel in channel_info:
-        info = channel.split()
-        channel_number = info[0][3:]
-        bias_status[channel_number] = {}
-        bias_status[channel_number]["bias_setpoint"] = float(info[1])
-        bias_status[channel_number]["current_limit"] = float(info[2])
-        bias_status[channel_number]["bias_readback"] = float(info[3])
-        bias_status[channel_number]["current_readback"] = float(info[4])
-        bias_status[channel_number]["channel_state"] = 1 if info[6] == "on" else 0
-        bias_status[channel_number]["channel_okay"] = 1 if info[7] == "Ok" else 0
-    return bias_status
+    await backend.async_read(metrics)
+
+
+"""
+Bias crate backends.  read() returns the bias_status dict and honours the
+deadline of the calling thread, async_read() fills in the dict passed to it.
+"""
+class BiasBackend:
+    name = "bias"
+
+    def read(self):
+        raise NotImplementedError
+
+    async def async_read(self, metrics):
+        loop = asyncio.get_event_loop()
+        metrics.update(await loop.run_in_executor(None, get_bias_status, self))
+
+    def close(self):
+        pass
+
+
+"""
+Runs sEPD_status.sh (or the "bias_script" from the config) for every read
+"""
+class ScriptBiasBackend(BiasBackend):
+    def __init__(self, script=bias_script):
+        self.script = script
 
+    def read(self):
+        start_time = time.perf_counter()
+        output = subprocess.check_output(self.script, timeout=remaining_time())
+        recorder.command(self.name, "script", "", time.perf_counter() - start_time)
+        return timed_parse(self.name, "script", parse_bias_status, output)
+
+    async def async_read(self, metrics):
+        start_time = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(self.script, stdout=asyncio.subprocess.PIPE)
+        try:
+            output, _ = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill() # unlike the forked version, the script does not outlive its deadline
+            raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, self.script)
+        recorder.command(self.name, "script", "", time.perf_counter() - start_time)
+        metrics.update(timed_parse(self.name, "script", parse_bias_status, output))
+
+
+"""
+Only the status script is implemented: the commands it sends to the bias
+crate are not known here, so there is no native client yet
+"""
+def make_bias_backend(configs):
+    backend = configs.get("bias_backend", "script")
+    if backend != "script":
+        logging.error(f"Unknown bias backend {backend}, using the status script")
+    return ScriptBiasBackend(configs.get("bias_script", bias_script))
+
+"""
+Decides which quantities are due on each poll.  Each quantity has an
+interval, a priority (lower is read first) and a deadline for reading it.
+The quantities of a controller crate share one session, so they are read
+together at the position of the first of them.
+With a "limit", the quantity is polled every "fast_interval" (default 1 s)
+while any reading is within "approach" (default 0.9) of the limit.
+Only the quantities read from the given sources are scheduled.
+"""
+class PollScheduler:
+    def __init__(self, configs, sources=sources):
+        self.quantities = {}
+        for name, defaults in default_schedule.items():
+            if not any(name in source_quantities[source] for source in sources):
+                continue
+            entry = {"interval" : configs.get("poll_rate", 10), "priority" : 0, "deadline" : default_timeout,
+                     "limit" : None, "approach" : 0.9, "fast_interval" : None}
+            entry.update(defaults)
+            entry.update(configs.get("schedule", {}).get(name, {}))
+            if entry["fast_interval"] is None:
+                entry["fast_interval"] = min(1, entry["interval"])
+            entry["next_due"] = 0
+            entry["fast"] = False
+            self.quantities[name] = entry
+
+    def due(self, now):
+        return self.order(name for name, entry in self.quantities.items() if entry["next_due"] <= now)
+
+    def order(self, names):
+        return sorted(names, key=lambda name: self.quantities[name]["priority"])
+
+    def deadline(self, name):
+        return self.quantities[name]["deadline"]
+
+    def polled(self, name, start_time, near_limit):
+        entry = self.quantities[name]
+        if near_limit != entry["fast"]:
+            logging.info(f"{name} {'approaching' if near_limit else 'back from'} its limit, polling every "
+                         f"{entry['fast_interval'] if near_limit else entry['interval']} seconds")
+        entry["fast"] = near_limit
+        entry["next_due"] = start_time + (entry["fast_interval"] if near_limit else entry["interval"])
+
+    def time_until_due(self, now):
+        if not self.quantities:
+            return default_timeout
+        return max(0, min(entry["next_due"] for entry in self.quantities.values()) - now)
+
+
+"""
+Reads the sEPD crates.  read_sources restricts the monitor to some of the LV
+crate, the north and south controllers and the bias crate, so each can be
+read by its own worker process; it defaults to "sources" in the config
+file, or all of them.
+"""
 class sepdMonitor:
-    def __init__(self, config_file=None):
-        self.IB_to_tile = None
-        self.tile_to_IB = None
+    def __init__(self, config_file=None, read_sources=None):
+        self.mapping_index = None
         if config_file is None:
             self.configs = self.load_configs()
         else:
             self.configs = self.load_configs(config_file)
+        if read_sources is None:
+            read_sources = self.configs.get("sources", sources)
+        self.sources = tuple(source for source in sources if source in read_sources)
         self.init_mapping()
 
         self.last_gain_state = {}
-        self.last_gain_update = time.time() - (20 * 60)
-        self.read_gain = False
         self.temperatures = {}
         self.interface_voltages = {}
         self.interface_currents = {}
         self.lv_voltages = {}
         self.lv_currents = {}
         self.bias = {}
-
-
+        self.last_update = {source : None for source in sources}
+        self.polled = None # quantities read by the last get_sEPD_metrics, None for all
+        self.scheduler = PollScheduler(self.configs, self.sources)
+        self.breakers = {}
+        for name in self.sources + tuple(f"ib{board + side_offsets[side]}" for side in self.controller_sides() for board in range(6)):
+            self.breakers[name] = CircuitBreaker(name, self.configs.get("breaker_threshold", 3), self.configs.get("breaker_probe_interval", 30))
+        self.connections = ConnectionManager(self.configs)
+        self.bias_backend = make_bias_backend(self.configs)
+        self.history = sepd_sc_history.HistoryBuffer(self.configs.get("history_samples", sepd_sc_history.default_samples),
+                                                     self.configs.get("history_bias_channels", sepd_sc_history.default_bias_channels))
+        logging.info(f"Keeping {self.history.samples} polls of history in {self.history.nbytes() / 1e6:.1f} MB")
 
     def init_mapping(self):
         if (self.configs["mapping"] is None):
             logging.error("No mapping found in config file")
             return
-        
-        def load_mapping(file):
-            mapping = []
-            with open(file, 'r') as csvfile:
-                reader = csv.reader(csvfile, delimiter=' ')
-                next(reader)  # Skip the first line
-                for row in reader:
-                    mapping.append(tuple([int(val) for val in row]))
-            return mapping
-
-        self.mapping = load_mapping(self.configs["mapping"])
-        
-        self.IB_to_tile = []
-        for IB in range(12):
-            self.IB_to_tile.append([])
-            for channel in range(64):
-                self.IB_to_tile[IB].append(-1)
-        
-        self.tile_to_IB = []
-        for side in range(2):
-            self.tile_to_IB.append([])
-            for sector in range(12):
-                self.tile_to_IB[side].append([])
-                for tile in range(32):
-                    self.tile_to_IB[side][sector].append(-1)
-
-        for side, sector, tile, interface_board, channel in self.mapping:
-            self.IB_to_tile[interface_board][channel] = (side, sector, tile)
-            self.tile_to_IB[side][sector][tile] = (interface_board, channel)
+
+        self.mapping_index = sepd_sc_mapping.load(self.configs["mapping"], self.configs.get("mapping_cache"))
+        self.mapping = self.mapping_index.rows()
+        self.channel_map = sepd_sc_channels.ChannelMap(self.mapping_index)
+        self.channels = sepd_sc_channels.ChannelStore(self.channel_map)
 
     def load_configs(self, file="monitoring_config.json"):
         with open(file, "r") as f:
             return json.load(f)
 
-    def get_sEPD_metrics(self):
-        timeout = 3
+    def metrics_response(self):
+        return {"temperatures" : self.temperatures,
+                "gain_modes" : self.last_gain_state,
+                "interface_voltages" : self.interface_voltages,
+                "interface_currents" : self.interface_currents,
+                "lv_voltages" : self.lv_voltages,
+                "lv_currents" : self.lv_currents,
+                "bias_info" : self.bias,
+                "channels" : self.channels}
 
-        # Updates from the low voltage crate
+    def update_quantity(self, quantity, values):
+        if quantity == "gain_modes":
+            self.last_gain_state.update(values) # gain modes are read rarely, keep boards which timed out
+        else:
+            setattr(self, quantity, values)
+
+    """
+    Readings which are compared with the quantity's limit
+    """
+    def limit_readings(self, quantity):
+        if quantity in sepd_sc_channels.ChannelStore.quantities:
+            return self.channels.values[quantity][self.channels.valid(quantity)]
+        if quantity == "lv":
+            return [float(channel[rail]) for board in self.lv_currents.values() for channel in board.values() for rail in ("positive", "negative")]
+        if quantity == "interface_voltages":
+            return [float(board["bias"]) for board in self.interface_voltages.values()]
+        if quantity == "bias":
+            return [channel["current_readback"] for channel in self.bias.values()]
+        return []
+
+    def near_limit(self, quantity):
+        entry = self.scheduler.quantities[quantity]
+        if quantity == "bias":
+            # the bias crate reports its own trip limits
+            for channel in self.bias.values():
+                if channel["current_limit"] > 0 and channel["current_readback"] >= entry["approach"] * channel["current_limit"]:
+                    return True
+        if entry["limit"] is None:
+            return False
+        return any(reading >= entry["approach"] * entry["limit"] for reading in self.limit_readings(quantity))
+
+    """
+    Reads the quantities which are due according to the schedule, or the
+    ones given.  Quantities which are not read keep their last values.
+    """
+    def get_sEPD_metrics(self, quantities=None):
+        start_time = time.time()
+        if quantities is None:
+            quantities = self.scheduler.due(start_time)
+        quantities = self.scheduler.order(quantity for quantity in quantities if quantity in self.scheduler.quantities)
+        logging.debug(f"Polling {quantities}")
+        # the channel readings are parsed straight into the store
+        self.channels.read = set()
+        for quantity in quantities:
+            if quantity in sepd_sc_channels.ChannelStore.quantities:
+                self.channels.clear(quantity)
+
+        if self.configs.get("acquisition", "serial") == "async":
+            self.connections.run(self.async_get_sEPD_metrics(quantities))
+        else:
+            self.serial_get_sEPD_metrics(quantities)
+
+        self.polled = quantities
+        for quantity in quantities:
+            self.scheduler.polled(quantity, start_time, self.near_limit(quantity))
+        return self.metrics_response()
+
+    def controller_sides(self):
+        return [side for side in ("north", "south") if side in self.sources]
+
+    """
+    Up/down state and last success of every source, as published with each
+    snapshot.  An interface board is only up while its controller crate is.
+    """
+    def health(self):
+        health = {name : {"up" : breaker.up(), "open" : breaker.open, "last_success" : breaker.last_success}
+                  for name, breaker in self.breakers.items()}
+        for side in self.controller_sides():
+            for board in range(6):
+                health[f"ib{board + side_offsets[side]}"]["up"] &= health[side]["up"]
+        return health
+
+    def record_source(self, source, success):
+        if success:
+            self.breakers[source].success()
+            self.last_update[source] = time.time()
+        else:
+            self.breakers[source].failure()
+
+    """
+    Interface boards of a side whose breakers let them be read this poll
+    """
+    def allowed_boards(self, side):
+        return [board for board in range(6) if self.breakers[f"ib{board + side_offsets[side]}"].allow()]
+
+    """
+    Attributes a controller read to its interface boards, once the session
+    to the crate was established; a crate which could not be reached is
+    only recorded against the crate.  Boards which
+    answered succeeded.  Replies come back in order, so the first board
+    missing from a quantity's results is the one which failed; the boards
+    after it were never reached and are not counted either way.  Returns
+    whether any board answered.
+    """
+    def record_boards(self, side, boards, results):
+        offset = side_offsets[side]
+        answered = set()
+        for values in results:
+            answered.update(values)
+        blamed = set()
+        for values in results:
+            missing = [board + offset for board in boards if board + offset not in values]
+            if missing:
+                blamed.add(missing[0])
+        for board in boards:
+            if board + offset in answered:
+                self.breakers[f"ib{board + offset}"].success()
+            elif board + offset in blamed:
+                self.breakers[f"ib{board + offset}"].failure()
+        return bool(answered)
+
+    """
+    The lv crate, the bias script and the controller crates in the order
+    of the first quantity each of them reads
+    """
+    @staticmethod
+    def read_order(quantities):
+        order = []
+        for quantity in quantities:
+            source = "controllers" if quantity in controller_quantities else quantity
+            if source not in order:
+                order.append(source)
+        return order
+
+    def serial_get_sEPD_metrics(self, quantities):
+        readers = {"lv" : self.serial_get_lv_metrics,
+                   "bias" : self.serial_get_bias_metrics,
+                   "controllers" : self.serial_get_controller_metrics}
+        for source in self.read_order(quantities):
+            readers[source](quantities)
+
+    # Updates from the low voltage crate
+    def serial_get_lv_metrics(self, quantities):
         self.lv_voltages = {}
         self.lv_currents = {}
-        success = False
-        tries = 0
-        while not success and tries < 1:
+        if self.breakers["lv"].allow():
             try:
-                with telnetlib.Telnet(self.configs["lv_host"], self.configs["lv_port"], 0.5) as crate:
-                    self.lv_voltages.update(get_lv_voltages(crate))
-                    self.lv_currents.update(get_lv_currents(crate))
-                    success = True
-            except socket.timeout:
-                tries += 1
-                logging.error("Could not connect to lv crate, try {}".format(tries))
-        if not success:
-            logging.error("Faking lv crate data")
-            self.lv_voltages.update(get_lv_voltages(crate, fake=True))
-            self.lv_currents.update(get_lv_currents(crate, fake=True))
-    
-        # Updates from the bias crate
+                with self.connections.session("lv") as crate:
+                    self.lv_voltages.update(get_lv_voltages(crate, deadline=self.scheduler.deadline("lv")))
+                    self.lv_currents.update(get_lv_currents(crate, deadline=self.scheduler.deadline("lv")))
+            except OSError as e:
+                logging.error("Could not connect to lv crate: {}".format(e))
+            self.record_source("lv", bool(self.lv_voltages or self.lv_currents))
+
+    # Updates from the bias crate
+    def serial_get_bias_metrics(self, quantities):
         self.bias = {}
-        self.bias = get_bias_status()
-
-        # Updates from the controller crates
-        if self.read_gain:
-            logging.debug("read gain, skipping updates...")
-            if time.time() - self.last_gain_update >= 11 * 60:
-                logging.debug("Resetting gain update")
-                self.last_gain_update = time.time()
-                self.read_gain = False
-            response = {"temperatures" : self.temperatures,
-            "gain_modes" : self.last_gain_state,
-            "interface_voltages" : self.interface_voltages,
-            "interface_currents" : self.interface_currents,
-            "lv_voltages" : self.lv_voltages,
-            "lv_currents" : self.lv_currents,
-            "bias_info" : self.bias}
-            return response
+        if self.breakers["bias"].allow():
+            self.bias = get_bias_status(self.bias_backend, deadline=self.scheduler.deadline("bias"))
+            self.record_source("bias", bool(self.bias))
 
-        self.temperatures = {}
-        self.interface_voltages = {}
-        self.interface_currents = {}
+    # Updates from the controller crates
+    def serial_get_controller_metrics(self, quantities):
+        readers = {"temperatures" : get_temperatures,
+                   "interface_voltages" : get_interface_voltages,
+                   "interface_currents" : get_interface_current,
+                   "gain_modes" : get_gain_mode}
+        controller = [quantity for quantity in quantities if quantity in controller_quantities]
+        results = {quantity : {} for quantity in controller}
+        for side in self.controller_sides():
+            # the side first, so an unreachable crate does not use up its boards' probes
+            if not self.breakers[side].allow():
+                continue
+            boards = self.allowed_boards(side)
+            if not boards:
+                continue
+            side_results = {quantity : {} for quantity in controller}
+            connected = False
+            try:
+                with self.connections.session(side) as crate:
+                    connected = True
+                    for quantity in controller:
+                        out = {"out" : self.channels.values[quantity]} if quantity in self.channels.quantities else {}
+                        side_results[quantity] = readers[quantity](crate, side, boards, deadline=self.scheduler.deadline(quantity), **out)
+            except OSError as e:
+                logging.error("Could not connect to {} controller crate: {}".format(side, e))
+            answered = connected and self.record_boards(side, boards, side_results.values())
+            self.record_source(side, answered)
+            for quantity in controller:
+                results[quantity].update(side_results[quantity])
+        for quantity in controller:
+            self.update_quantity(quantity, results[quantity])
 
-        self.read_gain = time.time() - self.last_gain_update >= 10 * 60
-        logging.debug(f"Reading gain: {self.read_gain}")
+    async def with_deadline(self, source, coroutine, deadline):
+        try:
+            await asyncio.wait_for(coroutine, deadline)
+        except asyncio.TimeoutError:
+            logging.warning(f"Reading {source} timed out in {deadline} seconds, keeping partial data")
+            recorder.timeout(source, coroutine.__name__)
+            return False
+        except (OSError, EOFError, asyncio.LimitOverrunError, subprocess.CalledProcessError) as e:
+            # EOFError covers asyncio.IncompleteReadError, a connection closed mid reply
+            logging.error(f"Reading {source} failed, keeping partial data: {type(e)}: {e}")
+            return False
+        return True
+
+    """
+    Same as serial_get_sEPD_metrics, but all crates and the bias script are
+    read at the same time so a cycle costs the slowest device rather than
+    the sum.  Each device gets the sum of the deadlines of what it reads.
+    The devices are started in the same order as the serial reads.
+    """
+    async def async_get_sEPD_metrics(self, quantities):
+        pipeline = self.configs.get("pipeline", False)
+        tasks = {}
+        lv = {"lv_voltages" : {}, "lv_currents" : {}}
+        if "lv" in quantities and self.breakers["lv"].allow():
+            tasks["lv"] = self.with_deadline("lv", async_get_lv_metrics(lv, self.connections.async_crates["lv"], pipeline),
+                                             2 * self.scheduler.deadline("lv"))
+        bias = {}
+        if "bias" in quantities and self.breakers["bias"].allow():
+            tasks["bias"] = self.with_deadline("bias", async_get_bias_status(bias, self.bias_backend), self.scheduler.deadline("bias"))
+
+        controller = [quantity for quantity in quantities if quantity in controller_quantities]
+        controllers = {}
+        boards = {}
+        connected = set()
+        if controller:
+            for side in self.controller_sides():
+                if not self.breakers[side].allow():
+                    continue
+                boards[side] = self.allowed_boards(side)
+                if not boards[side]:
+                    continue
+                controllers[side] = {quantity : {} for quantity in controller}
+                tasks[side] = self.with_deadline(side, async_get_controller_metrics(controllers[side],
+                                                                                    self.connections.async_crates[side],
+                                                                                    side, controller, pipeline, boards[side], self.channels.values,
+                                                                                    connected),
+                                                 sum(self.scheduler.deadline(quantity) for quantity in controller))
+        order = self.read_order(quantities)
+        tasks = dict(sorted(tasks.items(), key=lambda task: order.index(task[0] if task[0] in order else "controllers")))
+        # anything with_deadline does not expect only loses its own device
+        for source, result in zip(tasks, await asyncio.gather(*tasks.values(), return_exceptions=True)):
+            if isinstance(result, Exception):
+                logging.error(f"Reading {source} failed, keeping partial data: {type(result)}: {result}")
+
+        if "lv" in quantities:
+            self.lv_voltages = lv["lv_voltages"]
+            self.lv_currents = lv["lv_currents"]
+            if "lv" in tasks:
+                self.record_source("lv", bool(self.lv_voltages or self.lv_currents))
+        if "bias" in quantities:
+            self.bias = bias
+            if "bias" in tasks:
+                self.record_source("bias", bool(self.bias))
+
+        for side in controllers:
+            self.record_source(side, side in connected and self.record_boards(side, boards[side], controllers[side].values()))
+        for quantity in controller:
+            values = {}
+            for side in controllers:
+                values.update(controllers[side][quantity])
+            self.update_quantity(quantity, values)
+
+
+"""
+An immutable view of one completed polling cycle.  The metrics are deep
+copied when the snapshot is taken and must not be modified afterwards.
+polled lists the scheduled quantities read in the cycle, None for all.
+"""
+Snapshot = collections.namedtuple("Snapshot", ["generation", "timestamp", "duration", "metrics", "last_update", "health", "polled"])
 
-        for side in ("north", "south"):
-            try:
-                with telnetlib.Telnet(self.configs[f"{side}_controller_host"], self.configs[f"{side}_controller_port"], timeout) as crate:
-                    self.temperatures.update(get_temperatures(crate, side))
-                    self.interface_voltages.update(get_interface_voltages(crate, side))
-                    self.interface_currents.update(get_interface_current(crate, side))
-                    if self.read_gain:
-                        self.last_gain_state.update(get_gain_mode(crate, side))
-            except socket.timeout:
-                logging.error("Could not connect to controller crate")
-
-        
-
-        response = {"temperatures" : self.temperatures,
-                    "gain_modes" : self.last_gain_state,
-                    "interface_voltages" : self.interface_voltages,
-                    "interface_currents" : self.interface_currents,
-                    "lv_voltages" : self.lv_voltages,
-                    "lv_currents" : self.lv_currents,
-                    "bias_info" : self.bias}
-        return response
-        
-            
 
+"""
+Polls the monitor in a background thread whenever its scheduler has
+something due, at most once every min_interval seconds, and publishes the
+result as a Snapshot, so readers never wait on the crates.
+
+With "profile" set to a file name in the config, every poll runs under
+cProfile and the accumulated stats are written to that file every
+"profile_every" polls (default 100), for reading with pstats or snakeviz.
+The thread is named sepd-poller for py-spy.
+
+Each poll is also handed to archiver, if given, before the transform.
+"""
+class sepdPoller:
+    def __init__(self, monitor, min_interval=0, callback=None, transform=None, archiver=None):
+        self.monitor = monitor
+        self.min_interval = min_interval
+        self.callback = callback
+        self.transform = transform
+        self.archiver = archiver
+        self.snapshot = None
+        self.generation = 0
+        self.failures = 0
+        self.profile = monitor.configs.get("profile")
+        self.profile_every = monitor.configs.get("profile_every", 100)
+        self.profiler = cProfile.Profile() if self.profile else None
+        self.profiled = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="sepd-poller", daemon=True)
+
+    def start(self):
+        logging.info(f"Starting poller with a minimum interval of {self.min_interval} seconds")
+        if self.archiver is not None:
+            self.archiver.start()
+        self._thread.start()
 
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def age(self):
+        if self.snapshot is None:
+            return float("inf")
+        return time.time() - self.snapshot.timestamp
+
+    def poll(self):
+        start_time = time.time()
+        stage_start = time.perf_counter()
+        metrics = self.monitor.get_sEPD_metrics()
+        stage_start = self.stage_done("acquisition", stage_start)
+        poll_time = time.time()
+        self.monitor.history.append(poll_time, metrics, self.monitor.polled)
+        stage_start = self.stage_done("history", stage_start)
+        if self.archiver is not None:
+            self.archiver.append(poll_time, metrics, self.monitor.last_update)
+            stage_start = self.stage_done("archive", stage_start)
+        if self.transform is not None:
+            metrics = self.transform(metrics)
+            stage_start = self.stage_done("transform", stage_start)
+        metrics = copy.deepcopy(metrics)
+        self.stage_done("snapshot", stage_start)
+        self.generation += 1
+        snapshot = Snapshot(generation=self.generation,
+                            timestamp=time.time(),
+                            duration=time.time() - start_time,
+                            metrics=metrics,
+                            last_update=dict(self.monitor.last_update),
+                            health=self.monitor.health(),
+                            polled=None if self.monitor.polled is None else list(self.monitor.polled))
+        self.snapshot = snapshot # a single reference swap, safe to read from any thread
+        logging.debug(f"Published snapshot {snapshot.generation} after {snapshot.duration:.3f} seconds")
+        if self.callback is not None:
+            self.callback(snapshot)
+        return snapshot
+
+    def stage_done(self, stage, stage_start):
+        now = time.perf_counter()
+        recorder.stage(stage, now - stage_start)
+        return now
+
+    def run(self):
+        while not self._stop.is_set():
+            start_time = time.time()
+            if self.profiler is not None:
+                self.profiler.enable()
+            try:
+                self.poll()
+            except Exception as e:
+                self.failures += 1
+                logging.error(f"poller: caught {type(e)}: {e}")
+            if self.profiler is not None:
+                self.profiler.disable()
+                self.profiled += 1
+                if self.profiled % self.profile_every == 0:
+                    self.profiler.dump_stats(self.profile)
+                    logging.info(f"Wrote the profile of {self.profiled} polls to {self.profile}")
+            self._stop.wait(max(self.min_interval - (time.time() - start_time),
+                                self.monitor.scheduler.time_until_due(time.time())))
@@ -0,0 +1,139 @@
+"""
+Parsing of the crate replies.
+
+Replies are '>' terminated frames.  FrameBuffer collects the bytes read from
+a socket and hands out complete frames without rescanning what it already
+searched.  The parsers work on the raw frames and convert the numbers once,
+the channel readings straight into float arrays.  A frame which does not
+have the expected shape raises ProtocolError, which the readout treats as a
+bad reply from that one board rather than a failed crate.
+"""
+
+import logging
+
+import numpy as np
+
+channels_per_board = 64
+channels_per_lv_board = 16
+terminator = b">"
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class FrameBuffer:
+    def __init__(self):
+        self.data = bytearray()
+        self.scanned = 0 # bytes already searched for a terminator
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        del self.data[:]
+        self.scanned = 0
+
+    def feed(self, chunk):
+        self.data += chunk
+
+    """
+    Removes and returns the oldest complete frame, including its
+    terminator, or None if the terminator has not arrived yet
+    """
+    def pop(self, expected=terminator):
+        end = self.data.find(expected, self.scanned)
+        if end < 0:
+            self.scanned = max(0, len(self.data) - len(expected) + 1)
+            return None
+        end += len(expected)
+        frame = bytes(self.data[:end])
+        del self.data[:end]
+        self.scanned = 0
+        return frame
+
+
+"""
+$T and $I replies: 64 whitespace separated numbers.  Fills out if given,
+otherwise a new array, and returns it.  A bad value leaves out all NaN.
+"""
+def parse_channels(frame, out=None):
+    fields = frame.rstrip(terminator).split()
+    if len(fields) != channels_per_board:
+        raise ProtocolError(f"expected {channels_per_board} channels, got {len(fields)}")
+    if out is None:
+        out = np.empty(channels_per_board)
+    try:
+        out[:] = fields
+    except ValueError as e:
+        out[:] = np.nan
+        raise ProtocolError(f"bad channel value: {e}")
+    return out
+
+"""
+$A replies: "Normal" or the high gain mode
+"""
+def parse_gain_mode(frame):
+    text = frame.rstrip(terminator).strip()
+    if not text:
+        raise ProtocolError("empty gain mode")
+    return 'Normal' if b'Norm' in text else 'High'
+
+"""
+$U replies: "+V = 5.00, -V = -5.00, Bias = 55.00"
+"""
+def parse_interface_voltages(frame):
+    fields = frame.rstrip(terminator).strip().split(b",")
+    if len(fields) != 3:
+        raise ProtocolError(f"expected 3 voltages, got {len(fields)}")
+    voltages = {}
+    for rail, field in zip(("positive", "negative", "bias"), fields):
+        name, equals, value = field.partition(b"=")
+        if not equals:
+            raise ProtocolError(f"no value in {field!r}")
+        try:
+            voltages[rail] = float(value)
+        except ValueError:
+            raise ProtocolError(f"bad {rail} voltage {value!r}")
+    return voltages
+
+"""
+LV crate $V0n and $I0n replies: 16 comma separated numbers, the positive
+rails of channels 0-7 followed by the negative rails
+"""
+def parse_lv_channels(frame):
+    fields = frame.rstrip(terminator).strip().split(b",")
+    if len(fields) != channels_per_lv_board:
+        raise ProtocolError(f"expected {channels_per_lv_board} LV values, got {len(fields)}")
+    try:
+        values = [float(field) for field in fields]
+    except ValueError as e:
+        raise ProtocolError(f"bad LV value: {e}")
+    half = channels_per_lv_board // 2
+    return {i : {"positive" : values[i], "negative" : values[i + half]} for i in range(half)}
+
+"""
+Bias crate status, one line per channel:
+  ch_NN setpoint limit readback current ramp state okay
+Lines which do not parse are logged and skipped, the other channels are kept.
+"""
+def parse_bias_status(output):
+    if isinstance(output, str):
+        output = output.encode()
+    bias_status = {}
+    for line in output.rstrip(terminator).splitlines():
+        info = line.split()
+        if not info:
+            continue
+        try:
+            if len(info) < 8:
+                raise ProtocolError(f"expected 8 fields, got {len(info)}")
+            bias_status[info[0][3:].decode()] = {"bias_setpoint" : float(info[1]),
+                                                 "current_limit" : float(info[2]),
+                                                 "bias_readback" : float(info[3]),
+                                                 "current_readback" : float(info[4]),
+                                                 "channel_state" : 1 if info[6] == b"on" else 0,
+                                                 "channel_okay" : 1 if info[7] == b"Ok" else 0}
+        except (ProtocolError, ValueError) as e:
+            logging.error(f"Skipping bias status line {line!r}: {e}")
+    return bias_status
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""
+Simulates the LV crate and the two controller crates
+on the ports given in a monitoring config, for testing and benchmarking without the hardware.
+
+Commands are answered in order with a '>' prompt, like the real crates:
+  controllers  $Tn temperatures, $In SiPM currents, $Un voltages, $An gain mode
+  LV crate     $V0n voltages, $I0n currents
+Replies are delayed by --latency (+- --jitter) from when the command arrived,
+and a crate handles one command every --service seconds, so pipelined
+commands overlap their latency the same way they do on the network.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+
+class CrateSimulator:
+    def __init__(self, name, latency=0.005, jitter=0.0, service=0.001, drop_rate=0.0, off_boards=(), garble_rate=0.0):
+        self.name = name
+        self.garble_rate = garble_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.service = service
+        self.drop_rate = drop_rate
+        self.off_boards = set(off_boards)
+        self.offset = 6 if name == "south" else 0
+        self.commands = 0
+
+    def board_off(self, board):
+        return board + self.offset in self.off_boards
+
+    def controller_response(self, command, board):
+        if command == "$T":
+            if self.board_off(board):
+                return " ".join(["-99.00"] * 64) + "\r\n>"
+            return " ".join(f"{random.gauss(25, 0.5):.2f}" for _ in range(64)) + "\r\n>"
+        if command == "$I":
+            if self.board_off(board):
+                return " ".join(["2047.00"] * 64) + "\r\n>"
+            return " ".join(f"{abs(random.gauss(2, 0.2)):.2f}" for _ in range(64)) + "\r\n>"
+        if command == "$U":
+            if self.board_off(board):
+                return "+V = 15.00, -V = 0.00, Bias = 0.00\r>"
+            return f"+V = {random.gauss(5, 0.01):.2f}, -V = {random.gauss(-5, 0.01):.2f}, Bias = {random.gauss(55, 0.05):.2f}\r>"
+        if command == "$A":
+            return "Normal\r\n>"
+        return "Unknown command\r\n>"
+
+    def lv_response(self, command, board):
+        values = [f"{random.gauss(6, 0.02):.2f}" if command == "$V0" else f"{random.gauss(1.5, 0.05):.2f}" for _ in range(16)]
+        return "\r\n" + ",".join(values) + "\r>"
+
+    def respond(self, line):
+        command, board = line[:-1], line[-1:]
+        if not board.isdigit():
+            return "Unknown command\r\n>"
+        if self.name == "lv":
+            return self.lv_response(command, int(board))
+        return self.controller_response(command, int(board))
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        logging.info(f"{self.name}: connection from {peer}")
+        replies = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send(replies, writer))
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                buffer += data.replace(b"\r", b"\n")
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    line = line.decode().strip()
+                    if line:
+                        await replies.put((time.monotonic(), line))
+        except ConnectionError:
+            pass
+        finally:
+            await replies.put(None)
+            await sender
+            logging.info(f"{self.name}: connection from {peer} closed")
+
+    async def send(self, replies, writer):
+        last_reply = 0
+        while True:
+            item = await replies.get()
+            if item is None:
+                break
+            arrival, line = item
+            self.commands += 1
+            if random.random() < self.drop_rate:
+                logging.warning(f"{self.name}: dropping connection after {line}")
+                break
+            delay = max(0, self.latency + random.uniform(-self.jitter, self.jitter))
+            reply_time = max(arrival + delay, last_reply + self.service)
+            await asyncio.sleep(max(0, reply_time - time.monotonic()))
+            last_reply = time.monotonic()
+            reply = self.respond(line)
+            if random.random() < self.garble_rate:
+                logging.warning(f"{self.name}: truncating the reply to {line}")
+                reply = reply[:len(reply) // 2] + ">"
+            try:
+                writer.write(reply.encode("ascii"))
+                await writer.drain()
+            except ConnectionError:
+                break
+        writer.close()
+
+
+async def serve(configs, host, **kwargs):
+    servers = []
+    crates = [("lv", configs["lv_port"]),
+              ("north", configs["north_controller_port"]),
+              ("south", configs["south_controller_port"])]
+    for name, port in crates:
+        crate = CrateSimulator(name, **kwargs)
+        servers.append(await asyncio.start_server(crate.handle, host, port))
+        logging.info(f"Simulating {name} crate on {host}:{port}")
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='simulator',
+        description='Simulated LV and controller crates for the sEPD slow controls',
+        epilog='')
+    parser.add_argument('-c', '--sepd_config', default="monitoring_config.json", help='sEPD monitor config file to take the ports from')
+    parser.add_argument('--host', default="localhost", help='Address to listen on')
+    parser.add_argument('--latency', default=0.005, type=float, help='Reply latency per command in seconds')
+    parser.add_argument('--jitter', default=0.0, type=float, help='Random spread of the latency in seconds')
+    parser.add_argument('--service', default=0.001, type=float, help='Time a crate spends on each command in seconds')
+    parser.add_argument('--drop_rate', default=0.0, type=float, help='Probability of dropping the connection on each command')
+    parser.add_argument('--garble_rate', default=0.0, type=float, help='Probability of truncating each reply')
+    parser.add_argument('--off', default="", help='Comma separated interface boards (0-11) which are powered off')
+    args = parser.parse_args()
+
+    with open(args.sepd_config, "r") as f:
+        configs = json.load(f)
+    off_boards = [int(board) for board in args.off.split(",") if board]
+    try:
+        asyncio.run(serve(configs, args.host, latency=args.latency, jitter=args.jitter, service=args.service,
+                          drop_rate=args.drop_rate, off_boards=off_boards, garble_rate=args.garble_rate))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,17 @@
+"""
+WSGI entry point for serving the exporter with a production server, e.g.
+
+  SEPD_EXPORTER_ARGS="-c daq02_monitoring_config.json -l 5" \
+      gunicorn --workers 1 --threads 8 --bind 0.0.0.0:9113 sepd_sc_wsgi:app
+
+The exporter options are taken from SEPD_EXPORTER_ARGS (-p is ignored, the
+server binds the port).  Run a single worker process: the poller, the crate
+connections and the render cache live in the process, while its threads
+serve concurrent scrapes from the shared snapshot.  Do not use --preload,
+the poller thread would be started in the master and lost on fork.
+"""
+
+import sepd_sc_exporter
+
+app = sepd_sc_exporter.app
+sepd_sc_exporter.poller.start()
@@ -0,0 +1,44 @@
+import json
+import os
+import socket
+import sys
+
+import pytest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo)
+
+import sepd_sc_channels
+import sepd_sc_mapping
+
+mapping_file = os.path.join(repo, "sEPD_InterfaceMapping.txt")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def mapping_index(tmp_path):
+    return sepd_sc_mapping.load(mapping_file, str(tmp_path / "cache"))
+
+@pytest.fixture
+def channel_map(mapping_index):
+    return sepd_sc_channels.ChannelMap(mapping_index)
+
+@pytest.fixture
+def config_file(tmp_path):
+    with open(os.path.join(repo, "monitoring_config.json")) as f:
+        configs = json.load(f)
+    configs["mapping"] = mapping_file
+    configs["mapping_cache"] = str(tmp_path / "cache")
+    configs["breaker_threshold"] = 3
+    configs["breaker_probe_interval"] = 30
+    for crate in ("lv", "north_controller", "south_controller"):
+        configs[f"{crate}_host"] = "localhost"
+        configs[f"{crate}_port"] = free_port() # nothing listens, connections are refused
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(configs))
+    return str(path)
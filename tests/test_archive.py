@@ -0,0 +1,76 @@
+import os
+import time
+
+import numpy as np
+
+import sepd_sc_archive
+import sepd_sc_channels
+
+
+def poll_metrics(channel_map):
+    store = sepd_sc_channels.ChannelStore(channel_map)
+    store.values["temperatures"][3] = np.arange(64)
+    return {"temperatures" : {3 : store.values["temperatures"][3]},
+            "gain_modes" : {0 : "Normal", 6 : "High"},
+            "interface_voltages" : {1 : {"positive" : 5.0, "negative" : -5.0, "bias" : 55.0}},
+            "interface_currents" : {},
+            "lv_voltages" : {2 : {7 : {"positive" : 6.0, "negative" : -6.0}}},
+            "lv_currents" : {},
+            "bias_info" : {"05" : {"bias_setpoint" : 55.0, "current_limit" : 10.0, "bias_readback" : 54.5,
+                                   "current_readback" : 1.5, "channel_state" : 1, "channel_okay" : 1}},
+            "channels" : store}
+
+def archive_polls(archiver, metrics, timestamps):
+    for timestamp in timestamps:
+        archiver.append(timestamp, metrics, {"lv" : timestamp})
+    archiver.flush()
+
+
+def test_record_round_trip(channel_map):
+    metrics = poll_metrics(channel_map)
+    record = np.zeros(1, dtype=sepd_sc_archive.record_dtype)[0]
+    sepd_sc_archive.fill_record(record, 1000.0, metrics, {"north" : 999.0})
+    restored = sepd_sc_archive.record_metrics(record)
+    assert list(restored["temperatures"]) == [3]
+    assert np.array_equal(restored["temperatures"][3], np.arange(64))
+    for quantity in ("gain_modes", "interface_voltages", "lv_voltages", "bias_info"):
+        assert restored[quantity] == metrics[quantity]
+    assert restored["lv_currents"] == {} and restored["interface_currents"] == {}
+
+def test_append_and_load(tmp_path, channel_map):
+    archiver = sepd_sc_archive.SnapshotArchiver(str(tmp_path))
+    start = time.time()
+    archive_polls(archiver, poll_metrics(channel_map), [start, start + 1])
+    archive_polls(archiver, poll_metrics(channel_map), [start + 2])
+    records = sepd_sc_archive.load(archiver.file_for(start))
+    assert np.array_equal(records["timestamp"], [start, start + 1, start + 2])
+    assert archiver.written == 3
+
+def test_append_after_partial_record(tmp_path, channel_map):
+    archiver = sepd_sc_archive.SnapshotArchiver(str(tmp_path))
+    start = time.time()
+    archive_polls(archiver, poll_metrics(channel_map), [start + i for i in range(5)])
+    file = archiver.file_for(start)
+    os.truncate(file, os.path.getsize(file) - 100) # crash in the middle of the last record
+    archive_polls(archiver, poll_metrics(channel_map), [start + i for i in range(5, 8)])
+    records = sepd_sc_archive.load(file)
+    assert np.array_equal(records["timestamp"] - start, [0, 1, 2, 3, 5, 6, 7])
+    assert np.array_equal(records["temperatures"][-1, 3], np.arange(64))
+
+def test_incompatible_file_is_moved_aside(tmp_path, channel_map):
+    archiver = sepd_sc_archive.SnapshotArchiver(str(tmp_path))
+    start = time.time()
+    file = archiver.file_for(start)
+    with open(file, "wb") as f:
+        f.write(b"something else entirely")
+    archive_polls(archiver, poll_metrics(channel_map), [start])
+    assert len(sepd_sc_archive.load(file)) == 1
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".incompatible")]) == 1
+
+def test_prune(tmp_path):
+    archiver = sepd_sc_archive.SnapshotArchiver(str(tmp_path), keep_days=30)
+    now = time.time()
+    for days in (40, 31, 29, 0):
+        open(archiver.file_for(now - days * 86400), "wb").close()
+    archiver.prune(now)
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(archiver.file_for(now - days * 86400)) for days in (29, 0))
@@ -0,0 +1,90 @@
+import pytest
+
+import sepd_sc_monitoring
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_breaker_opens_and_probes(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sepd_sc_monitoring.time, "time", clock.time)
+    breaker = sepd_sc_monitoring.CircuitBreaker("lv", threshold=3, probe_interval=30)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.open and not breaker.up()
+    assert not breaker.allow()
+
+    clock.now += 31
+    assert breaker.allow() # one probe
+    assert not breaker.allow()
+    breaker.failure()
+    clock.now += 10
+    assert not breaker.allow()
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.success()
+    assert not breaker.open and breaker.up()
+    assert breaker.last_success == clock.now
+    assert breaker.allow()
+
+
+def test_board_blame(config_file):
+    monitor = sepd_sc_monitoring.sepdMonitor(config_file)
+    monitor.breakers["south"].success()
+    boards = [0, 1, 2, 3, 4, 5]
+    # south boards 6-11: temperatures stopped after board 8, currents answered for every board
+    results = [{6 : 1, 7 : 1, 8 : 1}, {6 : 1, 7 : 1, 8 : 1, 9 : 1, 10 : 1, 11 : 1}]
+    assert monitor.record_boards("south", boards, results)
+    assert all(monitor.breakers[f"ib{board}"].failures == 0 for board in range(6, 12))
+
+    results = [{6 : 1, 7 : 1}, {6 : 1}]
+    for _ in range(3):
+        assert monitor.record_boards("south", boards, results)
+    health = monitor.health()
+    assert health["ib6"]["up"] and health["ib7"]["up"]
+    assert health["ib8"]["open"] # first missing board of the temperatures
+    assert monitor.breakers["ib7"].failures == 0 # answered the temperatures, so not blamed for the currents
+    assert all(monitor.breakers[f"ib{board}"].failures == 0 for board in (9, 10, 11)) # never reached
+    assert monitor.allowed_boards("south") == [0, 1, 3, 4, 5]
+
+    # connected, but the first board never answered
+    assert not monitor.record_boards("north", boards, [{}, {}])
+    assert monitor.breakers["ib0"].failures == 1
+    assert all(monitor.breakers[f"ib{board}"].failures == 0 for board in range(1, 6))
+
+
+@pytest.mark.parametrize("acquisition", ["serial", "async"])
+def test_unreachable_crate_is_not_blamed_on_boards(config_file, acquisition):
+    monitor = sepd_sc_monitoring.sepdMonitor(config_file)
+    monitor.configs["acquisition"] = acquisition
+    for board in range(6):
+        monitor.breakers[f"ib{board}"].success()
+    monitor.breakers["north"].success()
+    for _ in range(3):
+        monitor.get_sEPD_metrics(["temperatures"])
+    assert monitor.breakers["north"].open
+    assert all(monitor.breakers[f"ib{board}"].failures == 0 for board in range(6))
+    health = monitor.health()
+    assert not health["north"]["up"]
+    assert not any(health[f"ib{board}"]["up"] for board in range(6)) # down with their crate
+
+    # the open crate is probed before any board, and no board probe is used up
+    assert not monitor.breakers["north"].allow()
+    assert monitor.allowed_boards("north") == [0, 1, 2, 3, 4, 5]
+
+
+def test_sources_are_read_in_priority_order(config_file, monkeypatch):
+    monitor = sepd_sc_monitoring.sepdMonitor(config_file)
+    read = []
+    for source in ("lv", "bias", "controller"):
+        monkeypatch.setattr(monitor, f"serial_get_{source}_metrics", lambda quantities, source=source: read.append(source))
+    monitor.get_sEPD_metrics(["gain_modes", "bias", "lv", "interface_currents"])
+    assert read == ["controller", "bias", "lv"] # interface_currents has priority 0, equal priorities keep the order given
@@ -0,0 +1,59 @@
+import numpy as np
+
+import sepd_sc_channels
+import sepd_sc_delta
+
+configs = {"deadbands" : {"temperatures" : {"absolute" : 0.1}}, "stale_polls" : 2}
+
+
+def poll(delta_filter, channel_map, temperatures=None, currents=None):
+    store = sepd_sc_channels.ChannelStore(channel_map)
+    for quantity, values in (("temperatures", temperatures), ("interface_currents", currents)):
+        if values is not None:
+            store.clear(quantity)
+            store.values[quantity][:] = values
+    return delta_filter.apply({"channels" : store})["channels"]
+
+
+def test_deadband(channel_map):
+    delta_filter = sepd_sc_delta.DeltaFilter(configs)
+    values = np.full((12, 64), 25.0)
+    published = poll(delta_filter, channel_map, temperatures=values)
+    assert delta_filter.counts[("temperatures", "forwarded")] == 768
+
+    values[0, 0] = 25.05 # inside the deadband
+    values[0, 1] = 25.5
+    published = poll(delta_filter, channel_map, temperatures=values)
+    assert published.values["temperatures"][0, 0] == 25.0
+    assert published.values["temperatures"][0, 1] == 25.5
+    assert delta_filter.counts[("temperatures", "forwarded")] == 769
+    assert delta_filter.counts[("temperatures", "suppressed")] == 767
+
+def test_board_switching_off_goes_stale(channel_map):
+    delta_filter = sepd_sc_delta.DeltaFilter(configs)
+    values = np.full((12, 64), 25.0)
+    poll(delta_filter, channel_map, temperatures=values)
+
+    values[2] = -99.0 # board 2 powered off
+    stale = []
+    for _ in range(3):
+        published = poll(delta_filter, channel_map, temperatures=values)
+        stale.append(published.stale["temperatures"][2].all())
+        assert np.isnan(published.values["temperatures"][2]).all()
+        assert not published.stale["temperatures"][3].any()
+    assert stale == [True, True, False] # stale_polls snapshots, then gone
+    assert delta_filter.counts[("temperatures", "stale")] == 64
+
+def test_only_read_quantities_are_counted(channel_map):
+    delta_filter = sepd_sc_delta.DeltaFilter(configs)
+    poll(delta_filter, channel_map, temperatures=np.full((12, 64), 25.0), currents=np.full((12, 64), 1.0))
+    for _ in range(5):
+        published = poll(delta_filter, channel_map, currents=np.full((12, 64), 1.0))
+    assert delta_filter.counts[("temperatures", "forwarded")] + delta_filter.counts[("temperatures", "suppressed")] == 768
+    assert delta_filter.counts[("interface_currents", "forwarded")] + delta_filter.counts[("interface_currents", "suppressed")] == 6 * 768
+    assert (published.values["temperatures"] == 25.0).all() # carried over from the last read
+
+def test_nothing_read_republishes(channel_map):
+    delta_filter = sepd_sc_delta.DeltaFilter(configs)
+    first = poll(delta_filter, channel_map, temperatures=np.full((12, 64), 25.0))
+    assert poll(delta_filter, channel_map) is first
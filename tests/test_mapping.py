@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+
+import sepd_sc_channels
+import sepd_sc_mapping
+
+mapping_file = os.path.join(os.path.dirname(os.path.abspath(sepd_sc_mapping.__file__)), "sEPD_InterfaceMapping.txt")
+
+
+def write_mapping(path, rows):
+    path.write_text("side sector tile interfaceBoard ch\n" + "".join(" ".join(map(str, row)) + "\n" for row in rows))
+    return str(path)
+
+
+def test_mapping_file_is_valid():
+    rows = sepd_sc_mapping.parse_mapping(mapping_file)
+    assert rows.shape == (768, 5)
+    sepd_sc_mapping.validate(rows)
+
+def test_out_of_range(tmp_path):
+    rows = sepd_sc_mapping.parse_mapping(mapping_file)
+    rows[10, 3] = 12
+    with pytest.raises(sepd_sc_mapping.MappingError, match="interface board out of range"):
+        sepd_sc_mapping.validate(rows)
+
+def test_tile_mapped_twice(tmp_path):
+    rows = sepd_sc_mapping.parse_mapping(mapping_file)
+    rows[1, :3] = rows[0, :3]
+    with pytest.raises(sepd_sc_mapping.MappingError, match="tiles mapped more than once"):
+        sepd_sc_mapping.validate(rows)
+
+def test_missing_channel(tmp_path):
+    rows = sepd_sc_mapping.parse_mapping(mapping_file)[:-1]
+    with pytest.raises(sepd_sc_mapping.MappingError, match="not mapped"):
+        sepd_sc_mapping.validate(rows)
+
+def test_wrong_columns(tmp_path):
+    file = write_mapping(tmp_path / "mapping.txt", [[0, 0, 0, 0]])
+    with pytest.raises(sepd_sc_mapping.MappingError, match="Expected 5 columns"):
+        sepd_sc_mapping.parse_mapping(file)
+
+def test_invalid_mapping_is_refused(tmp_path):
+    rows = sepd_sc_mapping.parse_mapping(mapping_file)
+    rows[0, 4] = rows[1, 4]
+    rows[0, 3] = rows[1, 3]
+    file = write_mapping(tmp_path / "mapping.txt", rows.tolist())
+    with pytest.raises(sepd_sc_mapping.MappingError):
+        sepd_sc_mapping.load(file, str(tmp_path / "cache"))
+    assert not (tmp_path / "cache").exists()
+
+
+def test_lookups_are_inverse(mapping_index):
+    boards, channels = np.indices((sepd_sc_channels.n_boards, sepd_sc_channels.n_channels)).reshape(2, -1)
+    sides, sectors, tiles = mapping_index.to_tile(boards, channels)
+    assert (sides >= 0).all()
+    back_boards, back_channels = mapping_index.to_channel(sides, sectors, tiles)
+    assert np.array_equal(back_boards, boards) and np.array_equal(back_channels, channels)
+    assert mapping_index.to_tile(4, 16) == (0, 0, 0)
+
+def test_rows_round_trip(mapping_index):
+    rows = mapping_index.rows()
+    sepd_sc_mapping.validate(rows)
+    assert sorted(map(tuple, rows.tolist())) == sorted(map(tuple, sepd_sc_mapping.parse_mapping(mapping_file).tolist()))
+
+def test_cached_index_is_reused(tmp_path):
+    cache = str(tmp_path / "cache")
+    compiled = sepd_sc_mapping.load(mapping_file, cache)
+    cached = sepd_sc_mapping.load(mapping_file, cache)
+    assert isinstance(cached.forward, np.memmap)
+    assert not isinstance(compiled.forward, np.memmap)
+    assert np.array_equal(cached.forward, compiled.forward)
+    assert np.array_equal(cached.reverse, compiled.reverse)
+
+
+def test_channel_store_tiles(channel_map):
+    store = sepd_sc_channels.ChannelStore(channel_map)
+    store.update("temperatures", 4, np.arange(64, dtype=float))
+    store.update("temperatures", 5, np.full(64, -99.0)) # powered off
+    tiles = store.tiles("temperatures")
+    assert tiles.shape == (2, 12, 32)
+    assert tiles[0, 0, 0] == 16 # board 4 channel 16
+    assert np.isfinite(tiles).sum() == 64
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+import sepd_sc_protocol
+from sepd_sc_protocol import ProtocolError
+
+
+def channels_frame(values):
+    return (" ".join(f"{value:.2f}" for value in values) + "\r\n>").encode()
+
+
+def test_frame_buffer_splits_frames():
+    buffer = sepd_sc_protocol.FrameBuffer()
+    buffer.feed(b"1 2>3 4")
+    assert buffer.pop() == b"1 2>"
+    assert buffer.pop() is None
+    buffer.feed(b" 5>")
+    assert buffer.pop() == b"3 4 5>"
+    assert len(buffer) == 0
+
+def test_frame_buffer_terminator_split_across_chunks():
+    buffer = sepd_sc_protocol.FrameBuffer()
+    buffer.feed(b"abc\r")
+    assert buffer.pop(b"\r\n>") is None
+    buffer.feed(b"\n>rest")
+    assert buffer.pop(b"\r\n>") == b"abc\r\n>"
+    assert bytes(buffer.data) == b"rest"
+
+
+def test_parse_channels():
+    values = sepd_sc_protocol.parse_channels(channels_frame(range(64)))
+    assert values.shape == (64,)
+    assert values[63] == 63
+
+def test_parse_channels_into_buffer():
+    out = np.full((2, 64), np.nan)
+    result = sepd_sc_protocol.parse_channels(channels_frame(range(64)), out=out[1])
+    assert np.shares_memory(result, out)
+    assert out[1, 5] == 5
+    assert np.isnan(out[0]).all()
+
+def test_truncated_channels():
+    out = np.zeros(64)
+    with pytest.raises(ProtocolError, match=r"expected 64 channels, got \d+"):
+        sepd_sc_protocol.parse_channels(channels_frame(range(64))[:100], out=out)
+    assert (out == 0).all() # the length is checked before anything is written
+
+def test_bad_channel_value_leaves_nan():
+    frame = channels_frame(range(64)).replace(b"7.00", b"7.x0")
+    out = np.zeros(64)
+    with pytest.raises(ProtocolError, match="bad channel value"):
+        sepd_sc_protocol.parse_channels(frame, out=out)
+    assert np.isnan(out).all()
+
+
+def test_parse_gain_mode():
+    assert sepd_sc_protocol.parse_gain_mode(b"Normal\r\n>") == "Normal"
+    assert sepd_sc_protocol.parse_gain_mode(b"High gain\r\n>") == "High"
+    with pytest.raises(ProtocolError):
+        sepd_sc_protocol.parse_gain_mode(b"\r\n>")
+
+def test_parse_interface_voltages():
+    voltages = sepd_sc_protocol.parse_interface_voltages(b"+V = 5.00, -V = -5.00, Bias = 55.00\r\n>")
+    assert voltages == {"positive" : 5.0, "negative" : -5.0, "bias" : 55.0}
+    with pytest.raises(ProtocolError, match="expected 3 voltages"):
+        sepd_sc_protocol.parse_interface_voltages(b"+V = 5.00, -V = -5>")
+    with pytest.raises(ProtocolError, match="bad bias voltage"):
+        sepd_sc_protocol.parse_interface_voltages(b"+V = 5.00, -V = -5.00, Bias = ?\r\n>")
+
+def test_parse_lv_channels():
+    frame = ("\r\n" + ",".join(str(i) for i in range(16)) + "\r>").encode()
+    channels = sepd_sc_protocol.parse_lv_channels(frame)
+    assert channels[0] == {"positive" : 0.0, "negative" : 8.0}
+    assert channels[7] == {"positive" : 7.0, "negative" : 15.0}
+    with pytest.raises(ProtocolError):
+        sepd_sc_protocol.parse_lv_channels(b"1,2,3>")
+
+def test_parse_bias_status_skips_bad_lines():
+    output = (b"ch_00 55.00 10.00 54.50 1.50 5.0 on Ok\n"
+              b"ch_01 55.00 10.00\n"
+              b"ch_02 55.00 10.00 x 1.50 5.0 on Ok\n"
+              b"ch_03 55.00 10.00 0.00 0.00 5.0 off Trip\n>")
+    status = sepd_sc_protocol.parse_bias_status(output)
+    assert sorted(status) == ["00", "03"]
+    assert status["00"]["bias_readback"] == 54.5
+    assert status["00"]["channel_state"] == 1 and status["00"]["channel_okay"] == 1
+    assert status["03"]["channel_state"] == 0 and status["03"]["channel_okay"] == 0